@@ -10,10 +10,16 @@ from . import manifest
 def register():
     Pool.register(
         api.CarrierApi,
+        api.CarrierApiSeurShard,
         api.CarrierApiSeurOffline,
+        api.CarrierApiSeurOfflineMail,
         api.CarrierApiSeurOfflineSendStart,
+        api.CarrierApiSeurLabel,
+        api.CarrierApiSeurRetry,
         api.CarrierApiSeurZip,
+        api.CarrierApiSeurZipConfiguration,
         api.LoadCarrierApiSeurZipStart,
+        api.LoadCarrierApiSeurZipResult,
         shipment.ShipmentOut,
         module='carrier_send_shipments_seur', type_='model')
     Pool.register(
@@ -2,21 +2,38 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from email import Utils
-from email import Encoders
 from email.header import Header
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from trytond.model import ModelSQL, ModelView, fields
+from collections import namedtuple
+from sql import Null
+from trytond.cache import Cache
+from trytond.model import ModelSQL, ModelView, ModelSingleton, fields
 from trytond.wizard import Wizard, StateView, StateTransition, Button
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Not, Equal, Bool
-from trytond.modules.carrier_send_shipments_seur.tools import seurbarcode
+from trytond import backend
+from trytond.config import config
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.modules.carrier_send_shipments_seur.tools import seurbarcodes, \
+    seur_zip_rows, seur_zip_fingerprint, seur_reference_overlaps, \
+    seur_backoff
+from trytond.modules.carrier_send_shipments_seur.timing import SeurTimer
+from trytond.modules.carrier_send_shipments_seur.client import \
+    pooled_session, session_pool, SEUR_TIMEOUT
+from trytond.modules.carrier_send_shipments_seur.profiling import \
+    seur_profile
 import logging
 import datetime
 import genshi
 import os
-import codecs
+import io
+import tempfile
+try:
+    from base64 import encodebytes
+except ImportError:
+    from base64 import encodestring as encodebytes
 
 try:
     from seur.picking import *
@@ -26,17 +43,107 @@ except ImportError:
     logger.error(message)
     raise Exception(message)
 
-__all__ = ['CarrierApi', 'CarrierApiSeurOffline',
-    'CarrierApiSeurOfflineSendStart', 'CarrierApiSeurOfflineSend',
-    'CarrierApiSeurZip', 'LoadCarrierApiSeurZipStart', 'LoadCarrierApiSeurZip']
+__all__ = ['CarrierApi', 'CarrierApiSeurShard', 'CarrierApiSeurOffline',
+    'CarrierApiSeurOfflineMail', 'CarrierApiSeurOfflineSendStart',
+    'CarrierApiSeurOfflineSend', 'CarrierApiSeurLabel',
+    'CarrierApiSeurRetry', 'CarrierApiSeurZip', 'CarrierApiSeurZipConfiguration',
+    'LoadCarrierApiSeurZipStart', 'LoadCarrierApiSeurZipResult',
+    'LoadCarrierApiSeurZip']
 __metaclass__ = PoolMeta
 
 logger = logging.getLogger(__name__)
+ZIP_CHUNK_SIZE = 5000
+OFFLINE_PAGE_SIZE = 500
+MAIL_MAX_ATTEMPTS = 10
+MAIL_LEASE = 600
+RETRY_MAX_ATTEMPTS = 10
+RETRY_BATCH_SIZE = 100
+SeurZipIndex = namedtuple('SeurZipIndex',
+    ['codpos_code', 'codpos_city', 'coddest_name'])
 offline_loader = genshi.template.TemplateLoader(
     os.path.join(os.path.dirname(__file__), 'template'),
     auto_reload=True)
 
 
+class _ChunkWriter(object):
+    'Buffer rows and write them with a function in chunks'
+
+    def __init__(self, write, chunk_size):
+        self.write = write
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.count = 0
+
+    def add(self, row):
+        self.chunk.append(row)
+        self.count += 1
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk:
+            self.write(self.chunk)
+            self.chunk = []
+
+
+class _Peekable(object):
+    'Iterator that splits its items in pages'
+    end = object()
+
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+        self.pending = next(self.iterator, self.end)
+
+    def page(self, output, max_items=None, max_size=None):
+        '''
+        Yield items until there are max_items or the output reaches
+        max_size, a page has at least one item
+        '''
+        count = 0
+        while self.pending is not self.end:
+            if count and ((max_items and count >= max_items)
+                    or (max_size and output.size >= max_size)):
+                return
+            item, self.pending = self.pending, next(self.iterator, self.end)
+            count += 1
+            yield item
+
+
+class _Base64Writer(object):
+    'Encode the written bytes to base64 lines in a temporary file'
+    # 57 bytes are encoded as a line of 76 characters
+    block_size = 57 * 64
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        self.buffer = b''
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.buffer += data
+        if len(self.buffer) >= self.block_size:
+            length = len(self.buffer) - len(self.buffer) % self.block_size
+            self.file.write(encodebytes(self.buffer[:length]))
+            self.buffer = self.buffer[length:]
+
+    def close(self):
+        if self.buffer:
+            self.file.write(encodebytes(self.buffer))
+            self.buffer = b''
+        return self.file
+
+
+def _copy_value(value):
+    'Format a value for a PostgreSQL COPY text row'
+    if value is None:
+        return u'\\N'
+    if isinstance(value, datetime.datetime):
+        return u'%s' % value.isoformat()
+    return (u'%s' % value).replace(u'\\', u'\\\\').replace(
+        u'\t', u'\\t').replace(u'\n', u'\\n').replace(u'\r', u'\\r')
+
+
 class CarrierApi:
     __name__ = 'carrier.api'
     seur_offline = fields.Boolean('Offline',
@@ -66,36 +173,134 @@ class CarrierApi:
     seur_aviso_email = fields.Boolean('Aviso Email')
     seur_aviso_sms = fields.Boolean('Aviso SMS')
     seur_reference = fields.Many2One('ir.sequence', 'Seur Reference', states={
-            'invisible': ~Bool(Eval('seur_offline')),
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
             'required': Bool(Eval('seur_offline')),
         }, domain=[
             ('code', '=', 'carrier.api.seur'),
-        ], depends=['seur_offline'],
+        ], depends=['seur_offline', 'seur_breaker_offline'],
         help='Sequence to assign a tracking reference')
     seur_minimum_reference = fields.Integer('Min Reference', states={
-            'invisible': ~Bool(Eval('seur_offline')),
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
             'required': Bool(Eval('seur_offline')),
-        }, depends=['seur_offline'],
+        }, depends=['seur_offline', 'seur_breaker_offline'],
         help='Minimum number reference')
     seur_maximun_reference = fields.Integer('Max Reference', states={
-            'invisible': ~Bool(Eval('seur_offline')),
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
             'required': Bool(Eval('seur_offline')),
-        }, depends=['seur_offline'],
+        }, depends=['seur_offline', 'seur_breaker_offline'],
         help='Maximun number reference')
+    seur_shards = fields.One2Many('carrier.api.seur.shard', 'api',
+        'Reference Shards', states={
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
+        }, depends=['seur_offline', 'seur_breaker_offline'],
+        help='Reference ranges with their own sequence, by warehouse. '
+        'With shards each warehouse must have its shard')
     seur_email = fields.Char('Seur Email', states={
-            'invisible': ~Bool(Eval('seur_offline')),
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
             'required': Bool(Eval('seur_offline')),
-        }, depends=['seur_offline'],
+        }, depends=['seur_offline', 'seur_breaker_offline'],
         help='Seur email, separated by comma')
     seur_email_cc = fields.Char('Seur CC Email', states={
-            'invisible': ~Bool(Eval('seur_offline')),
-        }, depends=['seur_offline'],
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
+        }, depends=['seur_offline', 'seur_breaker_offline'],
         help='Seur CC email, separated by comma')
     seur_filename = fields.Char('Seur Filename', states={
-            'invisible': ~Bool(Eval('seur_offline')),
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
             'required': Bool(Eval('seur_offline')),
-        }, depends=['seur_offline'],
+        }, depends=['seur_offline', 'seur_breaker_offline'],
         help='Prefix Seur Filename')
+    seur_max_shipments = fields.Integer('Max Shipments per File', states={
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
+        }, depends=['seur_offline', 'seur_breaker_offline'],
+        help='Split the Seur offline file in several emails when it has '
+        'more shipments. Unlimited if empty')
+    seur_max_size = fields.Integer('Max File Size', states={
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
+        }, depends=['seur_offline', 'seur_breaker_offline'],
+        help='Split the Seur offline file in several emails when it is '
+        'bigger (in kB). Unlimited if empty')
+    seur_zpl_stored_format = fields.Boolean('ZPL Stored Format', states={
+            'invisible': (~Bool(Eval('seur_offline'))
+                & ~Bool(Eval('seur_breaker_offline'))),
+        }, depends=['seur_offline', 'seur_breaker_offline'],
+        help='Send the label format to the printer once and only the '
+        'label fields for each package')
+    seur_label_batch = fields.Boolean('Batch Labels',
+        help='Write the labels of a batch to one file, a ZPL stream or a '
+        'merged PDF, with an index of the labels of each shipment')
+    seur_label_retention = fields.Integer('Label Retention',
+        help='Hours to keep the label files. Keep them forever if empty')
+    seur_label_store = fields.Boolean('Store Labels',
+        help='Store the labels of sent shipments and reprint them from the '
+        'store')
+    seur_label_store_days = fields.Integer('Stored Label Days', states={
+            'invisible': ~Bool(Eval('seur_label_store')),
+        }, depends=['seur_label_store'],
+        help='Days to keep the stored labels. Keep them forever if empty')
+    seur_label_store_size = fields.Integer('Stored Labels Size', states={
+            'invisible': ~Bool(Eval('seur_label_store')),
+        }, depends=['seur_label_store'],
+        help='Maximum size of the stored labels (in MB), the oldest labels '
+        'are removed first. Unlimited if empty')
+    seur_rate_limit = fields.Float('Rate Limit', states={
+            'invisible': Bool(Eval('seur_offline')),
+        }, depends=['seur_offline'],
+        help='Maximum Seur calls per second of all the workers of the '
+        'host with the same Seur account. Unlimited if empty')
+    seur_rate_burst = fields.Integer('Rate Burst', states={
+            'invisible': Bool(Eval('seur_offline')) | ~Eval('seur_rate_limit'),
+        }, depends=['seur_offline', 'seur_rate_limit'],
+        help='Seur calls allowed at once before the rate limit applies. '
+        'The rate limit if empty')
+    seur_breaker_errors = fields.Integer('Breaker Errors', states={
+            'invisible': Bool(Eval('seur_offline')),
+        }, depends=['seur_offline'],
+        help='Consecutive failed Seur calls (errors, timeouts or slow '
+        'answers) that open the circuit breaker. The remaining calls of the '
+        'batch fail fast while it is open. Disabled if empty')
+    seur_breaker_latency = fields.Float('Breaker Latency', states={
+            'invisible': (Bool(Eval('seur_offline'))
+                | ~Eval('seur_breaker_errors')),
+        }, depends=['seur_offline', 'seur_breaker_errors'],
+        help='Seconds of a Seur answer counted as a failed call')
+    seur_breaker_reset = fields.Integer('Breaker Reset', states={
+            'invisible': (Bool(Eval('seur_offline'))
+                | ~Eval('seur_breaker_errors')),
+        }, depends=['seur_offline', 'seur_breaker_errors'],
+        help='Seconds the circuit breaker is open before a new call is '
+        'tried (60 if empty)')
+    seur_breaker_offline = fields.Boolean('Offline Fallback', states={
+            'invisible': (Bool(Eval('seur_offline'))
+                | ~Eval('seur_breaker_errors')),
+        }, depends=['seur_offline', 'seur_breaker_errors'],
+        help='Send the shipments offline while the circuit breaker is open. '
+        'The offline settings are required')
+    seur_adaptive_timeout = fields.Boolean('Adaptive Timeout', states={
+            'invisible': Bool(Eval('seur_offline')),
+        }, depends=['seur_offline'],
+        help='Lower the timeout of the Seur calls to a multiple of the p95 '
+        'latency of the last answers')
+    seur_profile = fields.Boolean('Profile',
+        help='Profile the Seur send and print batches, the statistics are '
+        'written to a file and summarized in the log')
+    seur_retry = fields.Boolean('Retry Failed Shipments', states={
+            'invisible': Bool(Eval('seur_offline')),
+        }, depends=['seur_offline'],
+        help='Queue the shipments not sent to Seur and send them again '
+        'in background with exponential backoff')
+    seur_workers = fields.Integer('Workers', states={
+            'invisible': Bool(Eval('seur_offline')),
+        }, depends=['seur_offline'],
+        help='Number of Seur sessions that send shipments concurrently')
 
     @classmethod
     def __setup__(cls):
@@ -103,8 +308,75 @@ class CarrierApi:
         cls._error_messages.update({
             'working_offline': 'Can not test connection because are working '
                 'offline',
+            'seur_shard_missing': 'Warehouse "%(warehouse)s" has not a '
+                'reference shard in API "%(api)s".',
+            'seur_breaker_offline_settings': 'Offline settings are required '
+                'in API "%(name)s" to send offline when the Seur circuit '
+                'breaker is open',
             })
 
+    @staticmethod
+    def default_seur_workers():
+        return 4
+
+    @staticmethod
+    def default_seur_retry():
+        return True
+
+    @classmethod
+    def validate(cls, apis):
+        pool = Pool()
+        Shard = pool.get('carrier.api.seur.shard')
+        super(CarrierApi, cls).validate(apis)
+        for api in apis:
+            if api.seur_shards:
+                Shard.check_shards(api)
+            if api.seur_breaker_offline and not api.seur_offline:
+                api.check_seur_offline_settings()
+
+    def check_seur_offline_settings(self):
+        'Check the settings required by the offline fallback'
+        if not all((self.seur_reference, self.seur_minimum_reference,
+                    self.seur_maximun_reference, self.seur_email,
+                    self.seur_filename)):
+            self.raise_user_error('seur_breaker_offline_settings', {
+                    'name': self.rec_name,
+                    })
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierApi, cls).write(*args)
+        # the pooled Seur sessions of this process are opened again with
+        # the new values, other processes use new credentials as a new key
+        actions = iter(args)
+        for apis, _ in zip(actions, actions):
+            for api in apis:
+                session_pool.invalidate(api.id)
+
+    @classmethod
+    def delete(cls, apis):
+        for api in apis:
+            session_pool.invalidate(api.id)
+        super(CarrierApi, cls).delete(apis)
+
+    def get_seur_shard(self, warehouse):
+        '''
+        Sequence and reference range of a warehouse. The API range is only
+        used without shards, as the shard ranges are inside it.
+        Return (sequence, min_ref, max_ref)
+        '''
+        if not self.seur_shards:
+            return (self.seur_reference, self.seur_minimum_reference,
+                self.seur_maximun_reference)
+        for shard in self.seur_shards:
+            if shard.warehouse == warehouse:
+                return (shard.sequence, shard.minimum_reference,
+                    shard.maximum_reference)
+        self.raise_user_error('seur_shard_missing', {
+                'warehouse': warehouse.rec_name,
+                'api': self.rec_name,
+                })
+
     @classmethod
     def get_carrier_app(cls):
         '''
@@ -129,13 +401,87 @@ class CarrierApi:
         if api.seur_offline:
             cls.raise_user_error('working_offline')
 
-        seur_context = {}
-        with API(api.username, api.password, api.vat, api.seur_franchise, api.seur_seurid, \
-                api.seur_ci, api.seur_ccc, seur_context) as seur_api:
+        with pooled_session(api, kind='api') as seur_api:
             message = seur_api.test_connection()
         cls.raise_user_error(message)
 
 
+class CarrierApiSeurShard(ModelSQL, ModelView):
+    'Carrier API Seur Reference Shard'
+    __name__ = 'carrier.api.seur.shard'
+    api = fields.Many2One('carrier.api', 'API', required=True,
+        ondelete='CASCADE', select=True)
+    warehouse = fields.Many2One('stock.location', 'Warehouse', required=True,
+        domain=[('type', '=', 'warehouse')])
+    sequence = fields.Many2One('ir.sequence', 'Sequence', required=True,
+        domain=[
+            ('code', '=', 'carrier.api.seur'),
+        ], help='Sequence to assign a tracking reference')
+    minimum_reference = fields.Integer('Min Reference', required=True)
+    maximum_reference = fields.Integer('Max Reference', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierApiSeurShard, cls).__setup__()
+        cls._error_messages.update({
+            'shard_range': 'Reference range of shard "%(shard)s" must be '
+                'inside the reference range of the API.',
+            'shard_overlap': 'Reference ranges %(first)s and %(second)s of '
+                'API "%(api)s" overlap.',
+            'shard_warehouse': 'Warehouse "%(warehouse)s" has more than one '
+                'shard in API "%(api)s".',
+            'shard_sequence': 'Sequence "%(sequence)s" of shard "%(shard)s" '
+                'is used by another shard or by API "%(api)s".',
+            })
+
+    @classmethod
+    def validate(cls, shards):
+        super(CarrierApiSeurShard, cls).validate(shards)
+        for api in set(s.api for s in shards):
+            cls.check_shards(api)
+
+    @classmethod
+    def check_shards(cls, api):
+        'Check the shards of an API do not overlap nor share sequences'
+        warehouses = set()
+        sequences = set([api.seur_reference]) if api.seur_reference else set()
+        min_ref = api.seur_minimum_reference
+        max_ref = api.seur_maximun_reference
+        for shard in api.seur_shards:
+            if (shard.minimum_reference > shard.maximum_reference
+                    or (min_ref is not None
+                        and shard.minimum_reference < min_ref)
+                    or (max_ref is not None
+                        and shard.maximum_reference > max_ref)):
+                cls.raise_user_error('shard_range', {
+                        'shard': shard.rec_name,
+                        })
+            if shard.warehouse in warehouses:
+                cls.raise_user_error('shard_warehouse', {
+                        'warehouse': shard.warehouse.rec_name,
+                        'api': api.rec_name,
+                        })
+            warehouses.add(shard.warehouse)
+            # a shared sequence would lock the packing stations again
+            if shard.sequence in sequences:
+                cls.raise_user_error('shard_sequence', {
+                        'sequence': shard.sequence.rec_name,
+                        'shard': shard.rec_name,
+                        'api': api.rec_name,
+                        })
+            sequences.add(shard.sequence)
+        overlaps = seur_reference_overlaps([
+                (s.minimum_reference, s.maximum_reference)
+                for s in api.seur_shards])
+        if overlaps:
+            first, second = overlaps[0]
+            cls.raise_user_error('shard_overlap', {
+                    'first': '%s-%s' % first,
+                    'second': '%s-%s' % second,
+                    'api': api.rec_name,
+                    })
+
+
 class CarrierApiSeurOffline(ModelSQL, ModelView):
     'Carrier API Seur Offline'
     __name__ = 'carrier.api.seur.offline'
@@ -202,10 +548,18 @@ class CarrierApiSeurOffline(ModelSQL, ModelView):
     @classmethod
     def send_seur_offline(cls):
         API = Pool().get('carrier.api')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
 
+        # the apis with pending shipments, also the online apis with
+        # shipments sent by the offline fallback
+        cursor.execute(*table.select(table.api,
+                where=table.state == 'draft',
+                group_by=table.api))
+        api_ids = [api_id for api_id, in cursor.fetchall()]
         for api in API.search([
                 ('method', '=', 'seur'),
-                ('seur_offline', '=', True),
+                ('id', 'in', api_ids),
                 ]):
             cls.send_seur_shipments(api)
 
@@ -213,105 +567,339 @@ class CarrierApiSeurOffline(ModelSQL, ModelView):
     def send_seur_shipments(cls, api):
         pool = Pool()
         SMTP = pool.get('smtp.server')
-        ShipmentOut = pool.get('stock.shipment.out')
-        CarrierApi = pool.get('carrier.api')
 
         server = SMTP.get_smtp_server_from_model(cls.__name__)
         if not server:
             cls.raise_user_error('no_smtp_seur')
 
-        seur_shipments = cls.search([
-            ('api', '=', api),
-            ('state', '=', 'draft'),
-            ('shipment.state', 'in', ['packed', 'done']),
-            ])
-        if not seur_shipments:
-            return
+        # the backlog is sent in pages ordered by id, each page is committed
+        # so a failure does not discard the pages already sent
+        transaction = Transaction()
+        page_size = config.getint('carrier_send_shipments_seur',
+            'offline_page_size', default=OFFLINE_PAGE_SIZE)
+        date = datetime.datetime.now().strftime("%d%m%Y%H%M")
+        last_id, number = 0, 0
+        with seur_profile(transaction.database.name, 'offline', api):
+            while True:
+                seur_shipments = cls.search([
+                    ('api', '=', api),
+                    ('state', '=', 'draft'),
+                    ('shipment.state', 'in', ['packed', 'done']),
+                    ('id', '>', last_id),
+                    ], order=[('id', 'ASC')], limit=page_size)
+                if not seur_shipments:
+                    break
+                last_id = seur_shipments[-1].id
+                number = cls.send_seur_page(api, server, seur_shipments,
+                    date, number,
+                    numbered=bool(number) or len(seur_shipments) == page_size)
+                transaction.commit()
 
-        default_service = CarrierApi.get_default_carrier_service(api)
+    @classmethod
+    def send_seur_page(cls, api, server, seur_shipments, date, number=0,
+            numbered=False):
+        '''
+        Send a page of Seur offline shipments
+        :param api: obj
+        :param server: smtp.server obj
+        :param seur_shipments: list
+        :param date: str of the filenames
+        :param number: int of the last numbered file
+        :param numbered: bool to number the filenames
+        Return the number of the last file
+        '''
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        Mail = pool.get('carrier.api.seur.offline.mail')
 
-        shipments_data = []
-        for s in seur_shipments:
-            shipment = s.shipment
+        timer = SeurTimer('send_offline_page',
+            database=Transaction().database.name, api=api.id,
+            shipments=len(seur_shipments))
+        with timer.phase('prefetch'):
+            shipments = ShipmentOut.prefetch_seur(api,
+                [s.shipment for s in seur_shipments], api.weight)
+        with timer.phase('zip'):
+            seur_zips = ShipmentOut.get_seur_zips(api, shipments,
+                offline=True)
+        with timer.phase('batch'):
+            batch = ShipmentOut.get_seur_batch(api, shipments, api.weight,
+                seur_zips, offline=True)
+        default_service = batch.default_service
 
-            if not shipment.carrier_tracking_ref:
-                logger.error('It is missing the tracking ref in shipment "%s"' % (
-                    shipment.rec_name))
-                continue
+        def shipments_data():
+            for shipment in shipments:
+                if not shipment.carrier_tracking_ref:
+                    logger.error('It is missing the tracking ref in shipment "%s"' % (
+                        shipment.rec_name))
+                    continue
 
-            if shipment.warehouse.address:
-                waddress = shipment.warehouse.address
-            else:
-                waddress = api.company.party.addresses[0]
-            from_zip = waddress.zip
+                if shipment.warehouse.address:
+                    waddress = shipment.warehouse.address
+                else:
+                    waddress = api.company.party.addresses[0]
+                from_zip = waddress.zip
 
-            price = None
-            if shipment.carrier_cashondelivery:
-                price = shipment.carrier_cashondelivery_price
+                price = None
+                if shipment.carrier_cashondelivery:
+                    price = shipment.carrier_cashondelivery_price
 
-            service = (shipment.carrier_service or
-                (shipment.carrier and shipment.carrier.service)
-                or default_service)
+                service = (shipment.carrier_service or
+                    (shipment.carrier and shipment.carrier.service)
+                    or default_service)
 
-            vals = ShipmentOut.seur_picking_data(api, shipment, service, price,
-                api.weight)
+                with timer.phase('picking_data'):
+                    vals = ShipmentOut.seur_picking_data(api, shipment,
+                        service, price, api.weight, batch=batch)
 
-            barcodes = []
-            barcodes_compact = []
-            for seur_reference in shipment.carrier_tracking_ref.split(','):
-                barcode = seurbarcode(
+                barcodes = seurbarcodes(
                     from_zip=from_zip,
                     to_zip=vals['seur_codpos_code'],
-                    reference=seur_reference,
+                    references=shipment.carrier_tracking_ref.split(','),
                     transport=1) # TODO transport type is fixed to 1
-                barcodes.append(barcode)
-                barcodes_compact.append(barcode.replace (' ', ''))
-            vals['barcodes'] = barcodes
-            vals['barcodes_compact'] = barcodes_compact
-            # add shipment to send to seur
-            shipments_data.append(vals)
-
-        vals = {}
-        vals['ci'] = api.seur_ci
-        vals['vat'] = api.vat
-        vals['ccc'] = api.seur_ccc
-        vals['shipments'] = shipments_data
-        tmpl = offline_loader.load('offline-send.xml')
-        xml = tmpl.generate(**vals).render(encoding='iso-8859-1')
+                vals['barcodes'] = [b for b, _ in barcodes]
+                vals['barcodes_compact'] = [c for _, c in barcodes]
+                # add shipment to send to seur
+                yield vals
 
-        # TODO two-phase commit protocol
-        # https://bugs.tryton.org/issue3553
+        # the shipments are streamed to the files, the render phase
+        # includes their picking data
+        with timer.phase('render'):
+            files = list(cls.render_seur_files(api, shipments_data()))
 
         from_ = server.smtp_email
         recipients = api.seur_email.split(',')
         if api.seur_email_cc:
             recipients += api.seur_email_cc.split(',')
-        filename = '%s_%s.txt' % (api.seur_filename, datetime.datetime.now().strftime("%d%m%Y%H%M"))
-        subject = '%s - %s - %s' % (api.seur_seurid, api.seur_ccc, filename)
 
-        msg = MIMEMultipart()
-        msg['Subject'] = Header(subject, 'utf-8')
-        msg['From'] = from_
-        msg['To'] = api.seur_email
-        if api.seur_email_cc:
-            msg['Cc'] = api.seur_email_cc
-        msg['Reply-to'] = server.smtp_email
-        # msg['Date']     = Utils.formatdate(localtime = 1)
-        msg['Message-ID'] = Utils.make_msgid()
+        to_create = []
+        for encoded in files:
+            number += 1
+            if numbered or len(files) > 1:
+                filename = '%s_%s_%s.txt' % (api.seur_filename, date, number)
+            else:
+                filename = '%s_%s.txt' % (api.seur_filename, date)
+            subject = '%s - %s - %s' % (api.seur_seurid, api.seur_ccc, filename)
+
+            msg = MIMEMultipart()
+            msg['Subject'] = Header(subject, 'utf-8')
+            msg['From'] = from_
+            msg['To'] = api.seur_email
+            if api.seur_email_cc:
+                msg['Cc'] = api.seur_email_cc
+            msg['Reply-to'] = server.smtp_email
+            # msg['Date']     = Utils.formatdate(localtime = 1)
+            msg['Message-ID'] = Utils.make_msgid()
+
+            # the payload is already base64 encoded by render_seur_files
+            attach = MIMEBase('application', "octet-stream")
+            encoded.seek(0)
+            attach.set_payload(encoded.read())
+            encoded.close()
+            attach['Content-Transfer-Encoding'] = 'base64'
+            attach.add_header('Content-Disposition',
+                'attachment; filename="%s"' % filename)
+            msg.attach(attach)
+            to_create.append({
+                    'api': api.id,
+                    'server': server.id,
+                    'filename': filename,
+                    'from_': from_,
+                    'recipients': ','.join(recipients),
+                    'message': msg.as_string(),
+                    })
+
+        # the mails are queued in the outbox with the state change and they
+        # are delivered by the outbox cron once committed
+        with timer.phase('write', len(to_create)):
+            cls.write(seur_shipments, {'state': 'done'})
+            if to_create:
+                Mail.create(to_create)
+        timer.close()
+        return number
+
+    @classmethod
+    def render_seur_files(cls, api, shipments):
+        '''
+        Render the Seur offline XML of shipments as a stream into base64
+        encoded files, a new file is started when the file reaches the
+        maximum shipments or size of the API
+        :param api: obj
+        :param shipments: iterable of picking data
+        Yield a file object with the encoded content of each file
+        '''
+        tmpl = offline_loader.load('offline-send.xml')
+        max_shipments = api.seur_max_shipments or None
+        max_size = (api.seur_max_size or 0) * 1024 or None
+
+        source = _Peekable(shipments)
+        while source.pending is not _Peekable.end:
+            output = _Base64Writer()
+            vals = {}
+            vals['ci'] = api.seur_ci
+            vals['vat'] = api.vat
+            vals['ccc'] = api.seur_ccc
+            vals['shipments'] = source.page(output, max_shipments, max_size)
+            for chunk in tmpl.generate(**vals).serialize():
+                output.write(chunk.encode('iso-8859-1', 'xmlcharrefreplace'))
+            yield output.close()
+
 
-        attach = MIMEBase('application', "octet-stream")
-        attach.set_payload(xml)
-        Encoders.encode_base64(attach)
-        attach.add_header('Content-Disposition',
-            'attachment; filename="%s"' % filename)
-        msg.attach(attach)
+class CarrierApiSeurOfflineMail(ModelSQL, ModelView):
+    'Carrier API Seur Offline Mail'
+    __name__ = 'carrier.api.seur.offline.mail'
+    _rec_name = 'filename'
+    api = fields.Many2One('carrier.api', 'API', required=True, readonly=True)
+    server = fields.Many2One('smtp.server', 'SMTP Server', required=True,
+        readonly=True)
+    filename = fields.Char('Filename', readonly=True)
+    from_ = fields.Char('From', readonly=True)
+    recipients = fields.Char('Recipients', readonly=True,
+        help='Recipients, separated by comma')
+    message = fields.Text('Message', readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+        ], 'State', readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+    sent_date = fields.DateTime('Sent Date', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierApiSeurOfflineMail, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, mails):
+        cls.write(mails, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': None,
+                })
+
+    @classmethod
+    def deliver_pending(cls, api=None):
+        'Deliver the due pending mails of the outbox (cron)'
+        now = datetime.datetime.now()
+        domain = [
+            ('state', '=', 'pending'),
+            ['OR',
+                ('next_attempt', '=', None),
+                ('next_attempt', '<=', now),
+                ],
+            ]
+        if api:
+            domain.append(('api', '=', api))
+        cls.deliver(cls.search(domain, order=[('id', 'ASC')]))
 
-        cls.write(seur_shipments, {'state': 'done'})
+    @classmethod
+    def claim(cls, mail):
+        '''
+        Claim a due pending mail for MAIL_LEASE seconds and commit, so a
+        concurrent delivery does not send it too. A mail that is not sent
+        nor failed once the lease expires is due again.
+        Return True if the mail is claimed
+        '''
+        DatabaseOperationalError = backend.get('DatabaseOperationalError')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        now = datetime.datetime.now()
+        try:
+            cursor.execute(*table.update([table.next_attempt],
+                    [now + datetime.timedelta(seconds=MAIL_LEASE)],
+                    where=(table.id == mail.id)
+                    & (table.state == 'pending')
+                    & ((table.next_attempt == Null)
+                        | (table.next_attempt <= now))))
+            claimed = cursor.rowcount == 1
+            transaction.commit()
+        except DatabaseOperationalError:
+            # claimed by a concurrent transaction
+            transaction.rollback()
+            claimed = False
+        return claimed
+
+    @classmethod
+    def deliver(cls, mails):
+        '''
+        Deliver the due mails, one SMTP connection by server. Each mail is
+        claimed before and committed once delivered, failed mails are
+        retried with exponential backoff.
+        '''
+        transaction = Transaction()
+        servers = {}
+        for mail in mails:
+            if cls.claim(mail):
+                servers.setdefault(mail.server, []).append(mail)
 
-        smtp_server = server.get_smtp_server()
-        smtp_server.sendmail(from_, recipients, msg.as_string())
-        smtp_server.quit()
-        logger.info('Send Seur Offline: %s' % (filename))
+        for server, server_mails in servers.items():
+            try:
+                smtp_server = server.get_smtp_server()
+            except Exception as e:
+                logger.error('Seur Offline SMTP connection: %s' % e)
+                cls.failed(server_mails, e)
+                transaction.commit()
+                continue
+            try:
+                for mail in server_mails:
+                    try:
+                        cls.deliver_message(smtp_server, mail)
+                    except Exception as e:
+                        logger.error('Not send Seur Offline %s: %s' % (
+                                mail.filename, e))
+                        cls.failed([mail], e)
+                    else:
+                        logger.info('Send Seur Offline: %s' % (mail.filename))
+                        cls.write([mail], {
+                                'state': 'sent',
+                                'sent_date': datetime.datetime.now(),
+                                'error': None,
+                                })
+                    transaction.commit()
+            finally:
+                try:
+                    smtp_server.quit()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def deliver_message(smtp_server, mail):
+        'Send the message of a mail with a SMTP connection'
+        smtp_server.sendmail(mail.from_, mail.recipients.split(','),
+            mail.message)
+
+    @classmethod
+    def failed(cls, mails, error):
+        now = datetime.datetime.now()
+        for mail in mails:
+            attempts = (mail.attempts or 0) + 1
+            values = {
+                'attempts': attempts,
+                'error': '%s' % error,
+                }
+            if attempts >= MAIL_MAX_ATTEMPTS:
+                values['state'] = 'failed'
+            else:
+                values['next_attempt'] = now + datetime.timedelta(
+                    seconds=seur_backoff(attempts))
+            cls.write([mail], values)
 
 
 class CarrierApiSeurOfflineSendStart(ModelView):
@@ -333,13 +921,341 @@ class CarrierApiSeurOfflineSend(Wizard):
     send = StateTransition()
 
     def transition_send(self):
-        Offline = Pool().get('carrier.api.seur.offline')
+        pool = Pool()
+        Offline = pool.get('carrier.api.seur.offline')
+        Mail = pool.get('carrier.api.seur.offline.mail')
 
         api = self.start.api
         Offline.send_seur_shipments(api)
+        Mail.deliver_pending(api)
         return 'end'
 
 
+class CarrierApiSeurLabel(ModelSQL, ModelView):
+    'Carrier API Seur Label'
+    __name__ = 'carrier.api.seur.label'
+    _rec_name = 'reference'
+    api = fields.Many2One('carrier.api', 'API', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    shipment = fields.Many2One('stock.shipment.out', 'Shipment',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    reference = fields.Char('Reference', required=True, select=True,
+        readonly=True, help='Carrier tracking reference')
+    package = fields.Integer('Package', required=True, readonly=True)
+    format = fields.Selection([
+        ('zpl', 'ZPL'),
+        ('pdf', 'PDF'),
+        ], 'Format', required=True, readonly=True)
+    stored_format = fields.Boolean('ZPL Stored Format', readonly=True,
+        help='The label only recalls the stored ZPL format')
+    data = fields.Binary('Label', readonly=True)
+    size = fields.Integer('Size', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierApiSeurLabel, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def get_format(api, offline=None):
+        '''
+        Format of the labels of an API
+        :param offline: bol of labels of shipments sent offline, api offline
+            if None
+        '''
+        if offline is None:
+            offline = api.seur_offline
+        return 'pdf' if api.seur_pdf and not offline else 'zpl'
+
+    @classmethod
+    def store(cls, api, labels, offline=None):
+        '''
+        Store labels of an API, replacing the labels with the same reference
+        :param api: obj
+        :param labels: list of (shipment, reference, package, data, stored_format)
+        :param offline: bol of labels of shipments sent offline, api offline
+            if None
+        '''
+        if not api.seur_label_store or not labels:
+            return
+        format_ = cls.get_format(api, offline)
+        references = list(set(l[1] for l in labels))
+        with Transaction().set_user(0):
+            old_labels = []
+            for sub_references in grouped_slice(references):
+                old_labels.extend(cls.search([
+                            ('api', '=', api),
+                            ('reference', 'in', list(sub_references)),
+                            ]))
+            if old_labels:
+                cls.delete(old_labels)
+            cls.create([{
+                        'api': api,
+                        'shipment': shipment,
+                        'reference': reference,
+                        'package': package,
+                        'format': format_,
+                        'stored_format': stored_format,
+                        'data': data,
+                        'size': len(data),
+                        } for shipment, reference, package, data, stored_format
+                    in labels])
+
+    @classmethod
+    def get_labels(cls, api, shipments, offline=None):
+        '''
+        Stored labels of the current tracking references of shipments
+        :param api: obj
+        :param shipments: list
+        :param offline: bol of shipments sent offline, api offline if None
+        Return dict of shipment id: list of labels ordered by package
+        '''
+        if not api.seur_label_store:
+            return {}
+        format_ = cls.get_format(api, offline)
+        references = {}
+        for shipment in shipments:
+            if shipment.carrier_tracking_ref:
+                references[shipment.id] = set(
+                    shipment.carrier_tracking_ref.split(','))
+        shipment_ids = list(references.keys())
+        labels = {}
+        for sub_ids in grouped_slice(shipment_ids):
+            for label in cls.search([
+                        ('api', '=', api),
+                        ('shipment', 'in', list(sub_ids)),
+                        ('format', '=', format_),
+                        ], order=[('package', 'ASC'), ('id', 'ASC')]):
+                if label.reference in references[label.shipment.id]:
+                    labels.setdefault(label.shipment.id, []).append(label)
+
+        # a shipment is reprinted from the store when it has a label for
+        # each reference
+        return {s: l for s, l in labels.items()
+            if set(x.reference for x in l) == references[s]}
+
+    @classmethod
+    def evict(cls):
+        'Remove the stored labels older or over the size of their API (cron)'
+        CarrierApi = Pool().get('carrier.api')
+
+        for api in CarrierApi.search([('method', '=', 'seur')]):
+            cls.evict_api(api)
+
+    @classmethod
+    def evict_api(cls, api):
+        '''
+        Remove the stored labels of an API older than the stored label days,
+        then the oldest labels over the stored labels size
+        Return number of removed labels
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        removed = 0
+        if api.seur_label_store_days:
+            limit = datetime.datetime.now() - datetime.timedelta(
+                days=api.seur_label_store_days)
+            cursor.execute(*table.delete(
+                    where=(table.api == api.id)
+                    & (table.create_date < limit)))
+            removed += cursor.rowcount
+
+        if api.seur_label_store_size:
+            max_size = api.seur_label_store_size * 1024 * 1024
+            cursor.execute(*table.select(table.id, table.size,
+                    where=table.api == api.id,
+                    order_by=table.id.desc))
+            total, to_delete = 0, []
+            for id_, size in cursor.fetchall():
+                total += size or 0
+                if total > max_size:
+                    to_delete.append(id_)
+            for sub_ids in grouped_slice(to_delete):
+                cursor.execute(*table.delete(
+                        where=reduce_ids(table.id, sub_ids)))
+            removed += len(to_delete)
+
+        if removed:
+            logger.info('Removed %s stored Seur labels of API %s'
+                % (removed, api.rec_name))
+        return removed
+
+
+class CarrierApiSeurRetry(ModelSQL, ModelView):
+    'Carrier API Seur Retry'
+    __name__ = 'carrier.api.seur.retry'
+    api = fields.Many2One('carrier.api', 'API', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    shipment = fields.Many2One('stock.shipment.out', 'Shipment',
+        required=True, ondelete='CASCADE', select=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ], 'State', readonly=True, select=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+    done_date = fields.DateTime('Done Date', readonly=True)
+    error = fields.Text('Error', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(CarrierApiSeurRetry, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def default_attempts():
+        return 0
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, retries):
+        cls.write(retries, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': None,
+                })
+
+    @classmethod
+    def enqueue(cls, api, failures):
+        '''
+        Queue the shipments not sent to Seur, the shipments already pending
+        are left to the queue. The calls without answer are not queued,
+        Seur may have created their shipments.
+        :param api: obj
+        :param failures: list of (shipment, error)
+        '''
+        failures = [(s, e) for s, e in failures if e != SEUR_TIMEOUT]
+        if not api.seur_retry or not failures:
+            return
+        now = datetime.datetime.now()
+        with Transaction().set_user(0):
+            pending = set(r.shipment.id for r in cls.search([
+                        ('shipment', 'in', [s.id for s, _ in failures]),
+                        ('state', '=', 'pending'),
+                        ]))
+            to_create = []
+            for shipment, error in failures:
+                if shipment.id in pending:
+                    continue
+                pending.add(shipment.id)
+                to_create.append({
+                        'api': api.id,
+                        'shipment': shipment.id,
+                        'next_attempt': now + datetime.timedelta(
+                            seconds=seur_backoff(1)),
+                        'error': error,
+                        })
+            if to_create:
+                cls.create(to_create)
+        if to_create:
+            logger.info('Queued %s Seur shipments to retry' % len(to_create))
+
+    @classmethod
+    def drain_pending(cls):
+        'Send again the pending shipments of the queue (cron)'
+        now = datetime.datetime.now()
+        cls.drain(cls.search([
+                    ('state', '=', 'pending'),
+                    ['OR',
+                        ('next_attempt', '=', None),
+                        ('next_attempt', '<=', now),
+                        ],
+                    ], order=[('id', 'ASC')]))
+
+    @classmethod
+    def drain(cls, retries):
+        '''
+        Send again the shipments of retries in batches by API, each batch is
+        committed once sent. The shipments still not sent are retried with
+        exponential backoff. The shipments sent are left not printed for the
+        operator to print their labels.
+        '''
+        pool = Pool()
+        ShipmentOut = pool.get('stock.shipment.out')
+        transaction = Transaction()
+
+        batch_size = config.getint('carrier_send_shipments_seur',
+            'retry_batch', default=RETRY_BATCH_SIZE)
+        apis = {}
+        for retry in retries:
+            apis.setdefault(retry.api, []).append(retry)
+
+        for api, api_retries in apis.items():
+            for i in range(0, len(api_retries), batch_size):
+                batch = api_retries[i:i + batch_size]
+                # shipments sent, cancelled or moved to another carrier
+                # since they were queued are not sent again
+                done = [r for r in batch
+                    if r.shipment.carrier_tracking_ref
+                    or r.shipment.state == 'cancel'
+                    or api.method != 'seur'
+                    or r.shipment.carrier not in api.carriers]
+                batch = [r for r in batch if r not in done]
+                errors = []
+                if batch:
+                    try:
+                        # the labels are printed by the operator
+                        with transaction.set_context(seur_retry=True):
+                            _, _, errors = ShipmentOut.send_seur(api,
+                                [r.shipment for r in batch])
+                    except Exception as e:
+                        transaction.rollback()
+                        logger.error('Seur retry of API %s: %s' % (
+                                api.rec_name, e))
+                        errors = ['%s' % e]
+                    # read the tracking references written by send_seur
+                    batch = cls.browse([r.id for r in batch])
+                    done += [r for r in batch
+                        if r.shipment.carrier_tracking_ref]
+                pending = [r for r in batch if r not in done]
+                cls.failed(pending, errors)
+                if done:
+                    cls.write(done, {
+                            'state': 'done',
+                            'done_date': datetime.datetime.now(),
+                            })
+                logger.info('Seur retry of API %s: %s shipments done, %s '
+                    'pending' % (api.rec_name, len(done), len(pending)))
+                transaction.commit()
+
+    @classmethod
+    def failed(cls, retries, errors):
+        '''
+        Schedule the next attempt of retries or fail them after the maximum
+        attempts or a call without answer, its shipment is retried by hand
+        once checked in Seur
+        :param errors: list of messages of the batch, the messages of each
+            shipment are kept
+        '''
+        now = datetime.datetime.now()
+        for retry in retries:
+            attempts = (retry.attempts or 0) + 1
+            name = retry.shipment.rec_name
+            values = {
+                'attempts': attempts,
+                'error': '\n'.join(e for e in errors if name in e)
+                    or 'Not send shipment "%s"' % name,
+                }
+            if (attempts >= RETRY_MAX_ATTEMPTS
+                    or SEUR_TIMEOUT in values['error']):
+                values['state'] = 'failed'
+            else:
+                values['next_attempt'] = now + datetime.timedelta(
+                    seconds=seur_backoff(attempts + 1))
+            cls.write([retry], values)
+
+
 class CarrierApiSeurZip(ModelSQL, ModelView):
     'Carrier API Seur Zip'
     __name__ = 'carrier.api.seur.zip'
@@ -349,6 +1265,169 @@ class CarrierApiSeurZip(ModelSQL, ModelView):
     codpos_code = fields.Char('CodPos Code')
     coddest_code = fields.Char('CodDest Code')
     coddest_name = fields.Char('CodDest Name')
+    _index_cache = Cache('carrier.api.seur.zip.index', size_limit=1,
+        context=False)
+
+    @classmethod
+    def get_index(cls):
+        '''
+        Index of Seur zips with a destination, loaded once per database
+        Return dict of (codpos_zip, codpos_country): SeurZipIndex
+        '''
+        index = cls._index_cache.get('index')
+        if index is not None:
+            return index
+
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*table.select(table.codpos_zip, table.codpos_country,
+                table.codpos_code, table.codpos_city, table.coddest_name,
+                where=table.coddest_name != Null,
+                order_by=table.id.asc))
+        index = {}
+        for zip_, country, code, city, coddest_name in cursor.fetchall():
+            index[(zip_, country)] = SeurZipIndex(code, city, coddest_name)
+        cls._index_cache.set('index', index)
+        return index
+
+    @classmethod
+    def bulk_load(cls, rows, chunk_size=ZIP_CHUNK_SIZE):
+        '''
+        Synchronize Seur zips with rows, only changed rows are written in
+        chunks with raw SQL
+        :param rows: iterable of (codpos_zip, codpos_city, codpos_country,
+            codpos_code, coddest_code, coddest_name)
+        :param chunk_size: int
+        Return (inserted, updated, deleted) counts
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        user, now = transaction.user, datetime.datetime.now()
+
+        # zips are keyed by the codpos values, the coddest values are the
+        # only ones that can be updated. The same key can be repeated.
+        existing = {}
+        cursor.execute(*table.select(table.id, table.codpos_zip,
+                table.codpos_city, table.codpos_country, table.codpos_code,
+                table.coddest_code, table.coddest_name,
+                order_by=table.id.asc))
+        for row in cursor.fetchall():
+            existing.setdefault(tuple(row[1:5]), []).append(
+                (row[0], tuple(row[5:])))
+
+        columns = [table.codpos_zip, table.codpos_city, table.codpos_country,
+            table.codpos_code, table.coddest_code, table.coddest_name,
+            table.create_uid, table.create_date]
+        if backend.name() == 'postgresql':
+            def insert(chunk):
+                data = io.BytesIO()
+                for row in chunk:
+                    data.write(u'\t'.join(_copy_value(v)
+                            for v in row + (user, now)).encode('utf-8')
+                        + b'\n')
+                data.seek(0)
+                cursor.copy_from(data, cls._table,
+                    columns=[c.name for c in columns])
+        else:
+            insert_query, _ = tuple(
+                table.insert(columns, [[''] * len(columns)]))
+
+            def insert(chunk):
+                cursor.executemany(insert_query,
+                    [row + (user, now) for row in chunk])
+
+        update_query, _ = tuple(table.update(
+                [table.coddest_code, table.coddest_name,
+                    table.write_uid, table.write_date],
+                ['', '', '', ''], where=table.id == ''))
+
+        def update(chunk):
+            cursor.executemany(update_query,
+                [value + (user, now, id_) for id_, value in chunk])
+
+        inserted, updated = _ChunkWriter(insert, chunk_size), \
+            _ChunkWriter(update, chunk_size)
+        for row in rows:
+            key, value = tuple(row[:4]), tuple(row[4:])
+            records = existing.get(key)
+            if not records:
+                inserted.add(row)
+                continue
+            for i, (id_, old_value) in enumerate(records):
+                if old_value == value:
+                    break
+            else:
+                i = 0
+            id_, old_value = records.pop(i)
+            if old_value != value:
+                updated.add((id_, value))
+        inserted.flush()
+        updated.flush()
+
+        to_delete = [id_ for records in existing.values()
+            for id_, _ in records]
+        for i in range(0, len(to_delete), chunk_size):
+            cursor.execute(*table.delete(
+                    where=table.id.in_(to_delete[i:i + chunk_size])))
+
+        if inserted.count or updated.count or to_delete:
+            # other workers drop their zip index when the transaction commits
+            cls._index_cache.clear()
+        return inserted.count, updated.count, len(to_delete)
+
+    @classmethod
+    def load(cls, fcodpos=None, fcoddest=None):
+        '''
+        Load the Seur codpos and coddest files unless they are the same as
+        the last loaded
+        :param fcodpos: path of codpos file, the module file if None
+        :param fcoddest: path of coddest file, the module file if None
+        Return (inserted, updated, deleted) counts or None if unchanged
+        '''
+        Configuration = Pool().get('carrier.api.seur.zip.configuration')
+
+        directory = os.path.dirname(__file__)
+        fcodpos = fcodpos or os.path.join(directory, 'seur-codpos.txt')
+        fcoddest = fcoddest or os.path.join(directory, 'seur-coddest.txt')
+
+        zip_config = Configuration(1)
+        fingerprint = seur_zip_fingerprint(fcodpos, fcoddest)
+        if zip_config.fingerprint == fingerprint:
+            return
+
+        inserted, updated, deleted = cls.bulk_load(
+            seur_zip_rows(fcodpos, fcoddest))
+        Configuration.write([zip_config], {
+                'fingerprint': fingerprint,
+                'load_date': datetime.datetime.now(),
+                })
+        logger.info('Load Seur zips: %s inserted, %s updated, %s deleted'
+            % (inserted, updated, deleted))
+        return inserted, updated, deleted
+
+    @classmethod
+    def create(cls, vlist):
+        cls._index_cache.clear()
+        return super(CarrierApiSeurZip, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(CarrierApiSeurZip, cls).write(*args)
+        cls._index_cache.clear()
+
+    @classmethod
+    def delete(cls, zips):
+        super(CarrierApiSeurZip, cls).delete(zips)
+        cls._index_cache.clear()
+
+
+class CarrierApiSeurZipConfiguration(ModelSingleton, ModelSQL):
+    'Carrier API Seur Zip Configuration'
+    __name__ = 'carrier.api.seur.zip.configuration'
+    fingerprint = fields.Char('Fingerprint', readonly=True,
+        help='Fingerprint of the last loaded Seur files')
+    load_date = fields.DateTime('Load Date', readonly=True)
 
 
 class LoadCarrierApiSeurZipStart(ModelView):
@@ -356,6 +1435,16 @@ class LoadCarrierApiSeurZipStart(ModelView):
     __name__ = 'carrier.api.seur.zip.load.start'
 
 
+class LoadCarrierApiSeurZipResult(ModelView):
+    'Load Carrier API Seur Zip Result'
+    __name__ = 'carrier.api.seur.zip.load.result'
+    unchanged = fields.Boolean('Unchanged', readonly=True,
+        help='Seur files are the same as the last loaded')
+    inserted = fields.Integer('Inserted', readonly=True)
+    updated = fields.Integer('Updated', readonly=True)
+    deleted = fields.Integer('Deleted', readonly=True)
+
+
 class LoadCarrierApiSeurZip(Wizard):
     'Load Carrier API Seur Zip Start'
     __name__ = 'carrier.api.seur.zip.load'
@@ -366,60 +1455,32 @@ class LoadCarrierApiSeurZip(Wizard):
             Button('Accept', 'accept', 'tryton-ok', default=True),
             ])
     accept = StateTransition()
+    result = StateView('carrier.api.seur.zip.load.result',
+        'carrier_send_shipments_seur.carrier_api_seur_load_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
 
     def transition_accept(self):
         SeurZip = Pool().get('carrier.api.seur.zip')
 
-        zips = SeurZip.search([])
-        if zips:
-            SeurZip.delete(zips)
-
-        fcodpos = os.path.join(os.path.dirname(__file__), 'seur-codpos.txt')
-        fcoddest = os.path.join(os.path.dirname(__file__), 'seur-coddest.txt')
-
-        # codpos:
-        # 0008733EL PLA DEL PENEDES       ES0930
-        # codpos_zip:08733
-        # codpos_city: EL PLA DEL PENEDESq
-        # codpos_country: ES
-        # codpos_code: 930
-
-        # coddest:
-        # 0930002001BCN-PENEDES       1
-        # coddest_code: 930
-        # coddest_name: BCN-PENEDES
-
-        codpos = {}
-        with codecs.open(fcodpos, 'r', 'UTF-8') as f:
-            for line in f:
-                codpos_code = u'%s' % line[35:38]
-                vals = {
-                    'codpos_city': u'%s' % line[7:32].rstrip(),
-                    'codpos_country': u'%s' % line[32:34],
-                    'codpos_code': codpos_code,
-                    }
-                if vals['codpos_country'] in ['ES']:
-                    vals['codpos_zip'] = u'%s' % line[2:7]
-                if vals['codpos_country'] in ['PT']:
-                    vals['codpos_zip'] = u'%s' % line[0:7]
-                if codpos_code in codpos:
-                    codpos[codpos_code].append(vals)
-                else:
-                    codpos[codpos_code] = [vals]
-
-        with codecs.open(fcoddest, 'r', 'UTF-8') as f:
-            for line in f:
-                coddest_code = u'%s' % line[1:4]
-                if coddest_code in codpos:
-                    for z in codpos[coddest_code]:
-                        z['coddest_code'] = coddest_code
-                        z['coddest_name'] = u'%s' % line[10:28].rstrip()
+        counts = SeurZip.load()
+        if counts is None:
+            self.result.unchanged = True
+            self.result.inserted = self.result.updated = \
+                self.result.deleted = 0
+            return 'result'
 
-        to_create = []
-        for _, v in codpos.iteritems():
-            to_create += v
+        inserted, updated, deleted = counts
+        self.result.unchanged = False
+        self.result.inserted = inserted
+        self.result.updated = updated
+        self.result.deleted = deleted
+        return 'result'
 
-        if to_create:
-            SeurZip.create(to_create)
-
-        return 'end'
+    def default_result(self, fields):
+        return {
+            'unchanged': self.result.unchanged,
+            'inserted': self.result.inserted,
+            'updated': self.result.updated,
+            'deleted': self.result.deleted,
+            }
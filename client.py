@@ -0,0 +1,453 @@
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import sys
+import math
+import time
+import socket
+import threading
+import logging
+from collections import deque
+from contextlib import contextmanager
+from seur.picking import Picking, API
+from trytond.config import config
+from trytond.modules.carrier_send_shipments_seur.ratelimit import \
+    seur_rate_values, seur_rate_wait
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+__all__ = ['picking_session', 'picking_dispatch', 'pooled_session', 'pooled',
+    'session_pool', 'get_breaker', 'BREAKER_OPEN', 'SEUR_TIMEOUT']
+
+logger = logging.getLogger(__name__)
+SESSION_IDLE = 300
+SESSION_POOL_SIZE = 8
+BREAKER_RESET = 60
+BREAKER_OPEN = 'Seur is not available, the circuit breaker is open'
+SEUR_TIMEOUT = ('Seur did not answer in time, check the shipment in Seur '
+    'before sending it again')
+LATENCY_SAMPLES = 200
+
+
+def picking_context(api, context=None):
+    'Picking context from carrier api'
+    if context is None:
+        context = {}
+        if api.seur_pdf:
+            context['pdf'] = True
+    return context
+
+
+def session_factory(kind, api, context=None, timeout=None):
+    '''
+    Return the pool key and a factory of new Seur sessions of an api. Both
+    are built from the api values, so the factory does not read the record
+    and can be called from the worker threads.
+    :param kind: str (picking, api)
+    '''
+    key = SessionPool.key(kind, api, context, timeout)
+    args = (api.username, api.password, api.vat, api.seur_franchise,
+        api.seur_seurid, api.seur_ci, api.seur_ccc)
+    if kind == 'picking':
+        kwargs = {
+            'timeout': timeout or api.timeout,
+            'context': picking_context(api, context),
+            }
+        return key, lambda: Picking(*args, **kwargs)
+    context = context or {}
+    return key, lambda: API(*(args + (context,)))
+
+
+def picking_session(api, context=None, timeout=None):
+    'Return a new Seur Picking session from carrier api'
+    return session_factory('picking', api, context, timeout)[1]()
+
+
+def api_session(api, context=None):
+    'Return a new Seur API session from carrier api'
+    return session_factory('api', api, context)[1]()
+
+
+class SessionPool(object):
+    '''
+    Per process pool of entered Seur sessions by carrier api credentials.
+    A session is closed when it is idle for more than idle seconds, when a
+    call with it failed or when its api is invalidated.
+    '''
+
+    def __init__(self, idle=SESSION_IDLE, size=SESSION_POOL_SIZE):
+        self.idle = idle
+        self.size = size
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.generations = {}
+
+    @staticmethod
+    def key(kind, api, context=None, timeout=None):
+        'Key of the sessions of an api, any credential change is a new key'
+        if kind == 'picking':
+            context = picking_context(api, context)
+        return (getattr(api, 'id', None), kind, api.username, api.password,
+            api.vat, api.seur_franchise, api.seur_seurid, api.seur_ci,
+            api.seur_ccc, timeout or api.timeout,
+            tuple(sorted((context or {}).items())))
+
+    def acquire(self, key, factory):
+        '''
+        Take an idle session of key or enter a new one from factory
+        Return (session, entered session, generation)
+        '''
+        now = time.time()
+        expired = []
+        item = None
+        with self.lock:
+            for k, items in list(self.sessions.items()):
+                alive = []
+                for session, entered, generation, used in items:
+                    if now - used > self.idle:
+                        expired.append(session)
+                    else:
+                        alive.append((session, entered, generation, used))
+                if alive:
+                    self.sessions[k] = alive
+                else:
+                    del self.sessions[k]
+            if self.sessions.get(key):
+                item = self.sessions[key].pop()[:3]
+            generation = self.generations.get(key[0], 0)
+        for session in expired:
+            self.close(session)
+        if item:
+            return item
+        session = factory()
+        return session, session.__enter__(), generation
+
+    def release(self, key, item, healthy=True):
+        'Return a session to the pool, close it if it is not healthy'
+        session, entered, generation = item
+        if healthy:
+            with self.lock:
+                items = self.sessions.setdefault(key, [])
+                if (generation == self.generations.get(key[0], 0)
+                        and len(items) < self.size):
+                    items.append((session, entered, generation, time.time()))
+                    return
+        self.close(session)
+
+    def invalidate(self, api_id):
+        '''
+        Close the idle sessions of an api, its sessions in use are closed
+        when they are released
+        '''
+        with self.lock:
+            self.generations[api_id] = self.generations.get(api_id, 0) + 1
+            keys = [k for k in self.sessions if k[0] == api_id]
+            expired = [i[0] for k in keys for i in self.sessions.pop(k)]
+        for session in expired:
+            self.close(session)
+
+    def clear(self):
+        'Close the idle sessions of all apis'
+        with self.lock:
+            api_ids = set(k[0] for k in self.sessions)
+        for api_id in api_ids:
+            self.invalidate(api_id)
+
+    @staticmethod
+    def close(session):
+        try:
+            session.__exit__(None, None, None)
+        except Exception as e:
+            logger.warning('Can not close Seur session: %s' % e)
+
+
+session_pool = SessionPool(
+    idle=config.getint('carrier_send_shipments_seur', 'session_idle',
+        default=SESSION_IDLE),
+    size=config.getint('carrier_send_shipments_seur', 'session_pool_size',
+        default=SESSION_POOL_SIZE))
+
+
+class Lease(object):
+    'Session taken from the pool, healthy until a call with it failed'
+    __slots__ = ['session', 'healthy']
+
+    def __init__(self, session):
+        self.session = session
+        self.healthy = True
+
+
+@contextmanager
+def pooled(key, factory):
+    '''
+    Lease of a Seur session of key from the pool of the process, a new one
+    from factory if there is no idle session. The session is closed instead
+    of returned to the pool when the block raises or marks the lease as not
+    healthy.
+    '''
+    item = session_pool.acquire(key, factory)
+    lease = Lease(item[1])
+    try:
+        yield lease
+    except Exception:
+        lease.healthy = False
+        raise
+    finally:
+        session_pool.release(key, item, lease.healthy)
+
+
+@contextmanager
+def pooled_session(api, context=None, kind='picking', timeout=None):
+    '''
+    Seur session of an api from the pool of the process
+    :param api: obj
+    :param context: dict of the session context, from api if None
+    :param kind: str (picking, api)
+    :param timeout: seconds of the Picking calls, api timeout if None
+    '''
+    with pooled(*session_factory(kind, api, context, timeout)) as lease:
+        yield lease.session
+
+
+def error_result(method, message):
+    'Result of a Picking call that failed with message'
+    if method == 'create':
+        return None, None, message
+    return None
+
+
+def is_timeout(exception):
+    'The exception is the timeout of a call, its outcome is unknown'
+    return (isinstance(exception, socket.timeout)
+        or isinstance(getattr(exception, 'reason', None), socket.timeout))
+
+
+def is_transport_error(exception):
+    '''
+    The exception is an error of the connection with Seur (socket, HTTP or
+    URL error), not an error of the code
+    '''
+    return isinstance(exception, (socket.error, IOError,
+            httplib.HTTPException))
+
+
+def reraise(exc_type, exc_value, tb):
+    'Raise an exception of a worker thread with its traceback'
+    if sys.version_info[0] < 3:
+        exec('raise exc_type, exc_value, tb')
+    raise exc_value.with_traceback(tb)
+
+
+class CircuitBreaker(object):
+    '''
+    Circuit breaker of the Seur calls of an api in the process.
+    The circuit opens after a number of consecutive failed calls (an
+    exception, a timeout or an answer slower than the latency threshold),
+    the calls fail fast while it is open and after the reset seconds one
+    call is let through to close it again.
+    It also keeps the latencies of the answers for the adaptive timeout.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.errors = None
+        self.latency = None
+        self.reset = BREAKER_RESET
+        self.adaptive = False
+
+    def configure(self, api):
+        'Set the thresholds from the api'
+        self.errors = getattr(api, 'seur_breaker_errors', None)
+        self.latency = getattr(api, 'seur_breaker_latency', None)
+        self.reset = getattr(api, 'seur_breaker_reset', None) or BREAKER_RESET
+        self.adaptive = getattr(api, 'seur_adaptive_timeout', False)
+
+    def is_open(self):
+        'The calls fail fast, the trial call is not taken into account'
+        with self.lock:
+            return self.opened is not None and (self.trial
+                or time.time() - self.opened < self.reset)
+
+    def allow(self):
+        'Return if a call can be done, the first call after reset is a trial'
+        with self.lock:
+            if self.opened is None:
+                return True
+            if self.trial or time.time() - self.opened < self.reset:
+                return False
+            self.trial = True
+            return True
+
+    def record(self, success, elapsed=None):
+        '''
+        Record the outcome of a call
+        :param success: bool, False for an exception or a timeout
+        :param elapsed: float of seconds of the answer
+        '''
+        with self.lock:
+            if success and elapsed is not None:
+                self.latencies.append(elapsed)
+                if self.latency and elapsed > self.latency:
+                    success = False
+            if success:
+                self.failures = 0
+                if self.opened is not None:
+                    logger.info('Seur circuit breaker closed')
+                self.opened = None
+                self.trial = False
+                return
+            self.failures += 1
+            if self.trial or (self.opened is None and self.errors
+                    and self.failures >= self.errors):
+                logger.warning('Seur circuit breaker opened after %s failed '
+                    'calls' % self.failures)
+                self.opened = time.time()
+                self.trial = False
+
+    def percentile(self, percent):
+        'Latency percentile of the last answers, None without enough answers'
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < config.getint('carrier_send_shipments_seur',
+                'adaptive_timeout_samples', default=20):
+            return None
+        return latencies[int(round(percent / 100.0 * (len(latencies) - 1)))]
+
+    def timeout(self, timeout):
+        '''
+        Timeout of the next calls: with adaptive timeout it is the p95
+        latency times adaptive_timeout_factor rounded up to seconds (the
+        sessions are pooled by timeout), not lower than adaptive_timeout_min
+        nor higher than the api timeout
+        '''
+        if not self.adaptive:
+            return timeout
+        p95 = self.percentile(95)
+        if p95 is None:
+            return timeout
+        adaptive = max(p95 * config.getfloat('carrier_send_shipments_seur',
+                'adaptive_timeout_factor', default=3.0),
+            config.getfloat('carrier_send_shipments_seur',
+                'adaptive_timeout_min', default=5.0))
+        adaptive = math.ceil(adaptive)
+        return min(adaptive, timeout) if timeout else adaptive
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(api):
+    'Circuit breaker of an api in the process'
+    api_id = getattr(api, 'id', None)
+    with _breakers_lock:
+        breaker = _breakers.get(api_id)
+        if breaker is None:
+            breaker = _breakers[api_id] = CircuitBreaker()
+    breaker.configure(api)
+    return breaker
+
+
+def picking_dispatch(api, method, datas, context=None):
+    '''
+    Call Picking method for each data with a pool of Picking sessions
+    :param api: obj
+    :param method: str (create, label, manifiesto)
+    :param datas: list of dicts
+    :param context: dict of the Picking context, from api if None
+    Return a list of results in the same order as datas
+    '''
+    results = [None] * len(datas)
+    if not datas:
+        return results
+    workers = max(min(api.seur_workers or 1, len(datas)), 1)
+    breaker = get_breaker(api)
+    # the socket timeout of the sessions cancels the calls without answer
+    timeout = breaker.timeout(api.timeout or None)
+    # the api values are read here, ORM records must not be read from the
+    # worker threads
+    key, factory = session_factory('picking', api, context, timeout)
+    rate = seur_rate_values(api)
+
+    def guarded(lease, data):
+        # the calls of an open circuit fail fast
+        if not breaker.allow():
+            return error_result(method, BREAKER_OPEN)
+        seur_rate_wait(rate)
+        start = time.time()
+        try:
+            result = getattr(lease.session, method)(data)
+        except Exception as e:
+            # the errors of the code are raised, a failed call is the error
+            # result of its data and the other calls of the batch go on
+            # (or fail fast once the circuit opens): Seur has created their
+            # shipments
+            if not is_transport_error(e):
+                raise
+            breaker.record(False)
+            # the connection of the session may be broken, it is closed
+            lease.healthy = False
+            # Seur may have done the call, the caller must not repeat it
+            if is_timeout(e):
+                logger.warning('Seur %s call timeout after %s seconds'
+                    % (method, timeout))
+                return error_result(method, SEUR_TIMEOUT)
+            logger.warning('Seur %s call failed: %s' % (method, e))
+            return error_result(method, '%s' % e)
+        breaker.record(True, time.time() - start)
+        return result
+
+    jobs = Queue()
+    for i, data in enumerate(datas):
+        jobs.put((i, data))
+    failures = []
+    session_errors = []
+
+    def worker():
+        try:
+            # a new session after a failed call
+            while not failures and not jobs.empty():
+                with pooled(key, factory) as lease:
+                    while not failures and lease.healthy:
+                        try:
+                            i, data = jobs.get_nowait()
+                        except Empty:
+                            break
+                        results[i] = guarded(lease, data)
+        except Exception as e:
+            if not is_transport_error(e):
+                failures.append(sys.exc_info())
+                return
+            # the jobs are left to the workers with a session
+            breaker.record(False)
+            logger.warning('Seur %s session failed: %s' % (method, e))
+            session_errors.append(e)
+
+    if workers == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if failures:
+        logger.error('Seur %s call failed: %s' % (method, failures[0][1]))
+        reraise(*failures[0])
+
+    # the jobs left when no session could be opened
+    while not jobs.empty():
+        i, _ = jobs.get_nowait()
+        results[i] = error_result(method, '%s' % session_errors[-1])
+    return results
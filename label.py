@@ -0,0 +1,278 @@
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import os
+import re
+import io
+import csv
+import time
+import codecs
+import logging
+import tempfile
+import threading
+import genshi
+import genshi.template
+from trytond.config import config
+try:
+    from PyPDF2 import PdfFileMerger, PdfFileReader
+except ImportError:
+    PdfFileMerger = None
+
+__all__ = ['ZPLTemplate', 'get_label_template', 'LabelRenderer',
+    'LabelWriter', 'cleanup_labels']
+
+logger = logging.getLogger(__name__)
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'template')
+FIELD = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}')
+LABEL_PREFIX = '%s-seur-label-'
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+try:
+    text_type = unicode
+except NameError:
+    text_type = str
+
+
+class ZPLTemplate(object):
+    '''
+    ZPL template compiled once into literal parts and field names.
+    Only ${name} substitutions are supported, values are rendered as Genshi
+    does (None is an empty string).
+    '''
+
+    def __init__(self, source):
+        rest = FIELD.sub('', source)
+        if '{%' in rest or '$' in rest:
+            raise ValueError('ZPL template only supports ${name} fields')
+        parts = FIELD.split(source)
+        self.source = source
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def stored_format(self):
+        '''
+        Split a template with a stored format (^DF) in its static format and
+        the template of the format recall (^XF)
+        Return (format, ZPLTemplate) or None
+        '''
+        recall = self.source.find('^XF')
+        start = self.source.rfind('^XA', 0, recall)
+        if recall < 0 or start < 0:
+            return None
+        format_ = self.source[:start]
+        if '^DF' not in format_ or FIELD.search(format_):
+            return None
+        return format_, ZPLTemplate(self.source[start:])
+
+    def render(self, vals):
+        result = [self.literals[0]]
+        for name, literal in zip(self.fields, self.literals[1:]):
+            value = vals.get(name)
+            if value is not None:
+                result.append(text_type(value))
+            result.append(literal)
+        return u''.join(result)
+
+
+class GenshiTemplate(object):
+    'Genshi text template with the ZPLTemplate interface'
+
+    def __init__(self, template):
+        self.template = template
+
+    def render(self, vals):
+        return self.template.generate(**vals).render(encoding=None)
+
+
+def get_label_template(name='offline-label.zpl'):
+    '''
+    Label template, built once per process
+    Set genshi_label in carrier_send_shipments_seur section of trytond
+    configuration to render custom templates with Genshi
+    '''
+    template = _templates.get(name)
+    if template is not None:
+        return template
+
+    with _templates_lock:
+        if name in _templates:
+            return _templates[name]
+        path = os.path.join(TEMPLATE_PATH, name)
+        template = None
+        if not config.getboolean('carrier_send_shipments_seur',
+                'genshi_label', default=False):
+            with codecs.open(path, 'r', 'UTF-8') as f:
+                try:
+                    template = ZPLTemplate(f.read())
+                except ValueError:
+                    logger.warning('Label template %s is rendered with '
+                        'Genshi' % name)
+        if template is None:
+            loader = genshi.template.TemplateLoader(TEMPLATE_PATH,
+                auto_reload=False)
+            template = GenshiTemplate(loader.load(name,
+                    cls=genshi.template.text.NewTextTemplate))
+        _templates[name] = template
+    return template
+
+
+def get_stored_format(name='offline-label.zpl'):
+    '''
+    Static format and recall template of a label template, built once per
+    process
+    Return (format, ZPLTemplate) or None when the template has no stored
+    format or it is rendered with Genshi
+    '''
+    key = (name, 'stored_format')
+    if key not in _templates:
+        template = get_label_template(name)
+        stored = None
+        if isinstance(template, ZPLTemplate):
+            stored = template.stored_format()
+        with _templates_lock:
+            _templates[key] = stored
+    return _templates[key]
+
+
+class LabelRenderer(object):
+    '''
+    Render the offline labels of a batch.
+    In stored format mode the static format (^DF) is only sent with the
+    first label, the next labels only recall it (^XF) with their fields.
+    '''
+
+    def __init__(self, stored_format=False, name='offline-label.zpl'):
+        self.template = get_label_template(name)
+        self.format = None
+        self.stored_format = False
+        if stored_format:
+            stored = get_stored_format(name)
+            if stored:
+                self.format, self.template = stored
+                self.stored_format = True
+            else:
+                logger.warning('Label template %s has not a stored format'
+                    % name)
+
+    def render(self, vals):
+        return self.prepare(self.template.render(vals))
+
+    def render_label(self, vals):
+        'Render a label without the static format'
+        return self.template.render(vals)
+
+    def prepare(self, zpl):
+        'Prepend the static format to the first label sent to the printer'
+        if self.format:
+            zpl = self.format + zpl
+            self.format = None
+        return zpl
+
+
+def cleanup_labels(dbname, retention):
+    '''
+    Remove the label files of a database older than retention hours
+    :param dbname: str
+    :param retention: int
+    '''
+    if not retention:
+        return
+    prefix = LABEL_PREFIX % dbname
+    limit = time.time() - retention * 3600
+    directory = tempfile.gettempdir()
+    for name in os.listdir(directory):
+        if not name.startswith(prefix):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < limit:
+                os.remove(path)
+        except OSError:
+            continue
+
+
+class LabelWriter(object):
+    '''
+    Write the labels of a batch to temporary files.
+    In batch mode all labels are written to one file, a ZPL stream or a
+    merged PDF, with a CSV index of the labels (or pages) of each shipment
+    in index_path once closed.
+    '''
+
+    def __init__(self, dbname, pdf=False, batch=False, retention=None):
+        self.dbname = dbname
+        self.suffix = '.pdf' if pdf else '.zpl'
+        self.batch = batch
+        if batch and pdf and not PdfFileMerger:
+            logger.warning('Install PyPDF2 to merge Seur PDF labels')
+            self.batch = False
+        self.pdf = pdf
+        self.prefix = LABEL_PREFIX % dbname
+        self.labels = []
+        self.index = []
+        self.index_path = None
+        self.position = 1
+        self.file = None
+        self.merger = None
+        cleanup_labels(dbname, retention)
+
+    def add(self, name, reference, data):
+        '''
+        Add a label
+        :param name: shipment code
+        :param reference: tracking reference
+        :param data: label bytes
+        '''
+        if not self.batch:
+            with tempfile.NamedTemporaryFile(
+                    prefix='%s%s-' % (self.prefix, reference),
+                    suffix=self.suffix, delete=False) as temp:
+                temp.write(data)
+            logger.info('Generated tmp label %s' % (temp.name))
+            self.labels.append(temp.name)
+            return
+
+        if self.pdf:
+            if not self.merger:
+                self.merger = PdfFileMerger()
+            reader = PdfFileReader(io.BytesIO(data))
+            self.merger.append(reader)
+            count = reader.getNumPages()
+        else:
+            if not self.file:
+                self.file = tempfile.NamedTemporaryFile(
+                    prefix='%sbatch-' % self.prefix,
+                    suffix=self.suffix, delete=False)
+            self.file.write(data)
+            count = 1
+        self.index.append((name, reference, self.position, count))
+        self.position += count
+
+    def close(self):
+        '''
+        Close the batch file and write its index
+        Return list of label paths
+        '''
+        if self.merger:
+            self.file = tempfile.NamedTemporaryFile(
+                prefix='%sbatch-' % self.prefix,
+                suffix=self.suffix, delete=False)
+            self.merger.write(self.file)
+            self.merger.close()
+            self.merger = None
+        if self.file:
+            self.file.close()
+            self.index_path = self.file.name + '.csv'
+            with open(self.index_path, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(['shipment', 'reference',
+                        'page' if self.pdf else 'label', 'count'])
+                for row in self.index:
+                    writer.writerow(row)
+            logger.info('Generated tmp label %s (%s labels, index %s)'
+                % (self.file.name, len(self.index), self.index_path))
+            self.labels.append(self.file.name)
+            self.file = None
+        return self.labels
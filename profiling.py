@@ -0,0 +1,70 @@
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import os
+import time
+import logging
+import tempfile
+import cProfile
+import pstats
+from contextlib import contextmanager
+from trytond.config import config
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+__all__ = ['seur_profile']
+
+logger = logging.getLogger(__name__)
+PROFILE_TOP = 20
+
+
+def profile_enabled(api):
+    '''
+    Profiling is enabled with Profile in the API or with SEUR_PROFILE
+    environment variable
+    '''
+    return bool(os.environ.get('SEUR_PROFILE')
+        or getattr(api, 'seur_profile', False))
+
+
+@contextmanager
+def seur_profile(dbname, name, api, size=None):
+    '''
+    Profile a Seur batch, dump its pstats file and log the top functions
+    The pstats files are written to profile_path in carrier_send_shipments_seur
+    section of trytond configuration (the temporary directory by default)
+    :param dbname: str
+    :param name: str of the batch (send, print, offline)
+    :param api: obj
+    :param size: int of shipments of the batch
+    '''
+    if not profile_enabled(api):
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        directory = config.get('carrier_send_shipments_seur', 'profile_path',
+            default=tempfile.gettempdir())
+        path = os.path.join(directory, '%s-seur-%s-%s-%s-%s.pstats' % (
+                dbname, name, api.id, time.strftime('%Y%m%d%H%M%S'),
+                size or 0))
+        try:
+            profiler.dump_stats(path)
+        except (IOError, OSError) as e:
+            logger.error('Can not write Seur profile %s: %s' % (path, e))
+            path = None
+
+        top = config.getint('carrier_send_shipments_seur', 'profile_top',
+            default=PROFILE_TOP)
+        stream = StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(top)
+        logger.info('Seur %s profile of %s shipments (%s):\n%s' % (
+                name, size, path, stream.getvalue()))
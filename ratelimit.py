@@ -0,0 +1,116 @@
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import os
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+from trytond.config import config
+
+__all__ = ['RateLimiter', 'seur_rate_values', 'seur_rate_wait']
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter(object):
+    '''
+    Token buckets shared by the processes of a host in a sqlite file.
+    Each bucket refills rate tokens per second up to burst tokens, a call
+    takes a token or waits until the bucket has one.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=60,
+                isolation_level=None)
+            connection.execute('CREATE TABLE IF NOT EXISTS bucket ('
+                'key TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self.local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        '''
+        Take a token from bucket key
+        Return the seconds to wait for a token, 0 if it is taken
+        '''
+        connection = self.connection()
+        # the immediate transaction locks the file for the other processes
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = connection.execute('SELECT tokens, updated FROM bucket '
+                'WHERE key = ?', (key,)).fetchone()
+            if row:
+                tokens, updated = row
+                tokens = min(burst, tokens + max(now - updated, 0) * rate)
+            else:
+                tokens = burst
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            connection.execute('INSERT OR REPLACE INTO bucket '
+                '(key, tokens, updated) VALUES (?, ?, ?)', (key, tokens, now))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return wait
+
+    def acquire(self, key, rate, burst=None):
+        '''
+        Wait for a token of bucket key
+        :param key: str
+        :param rate: float of tokens per second
+        :param burst: int of maximum tokens, rate if None
+        Return the waited seconds
+        '''
+        burst = max(burst or int(rate), 1)
+        waited = 0
+        while True:
+            wait = self.take(key, rate, burst)
+            if not wait:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+
+_limiter = RateLimiter(config.get('carrier_send_shipments_seur',
+        'rate_limit_path', default=os.path.join(tempfile.gettempdir(),
+            'trytond-seur-rate.sqlite')))
+
+
+def seur_rate_values(api):
+    '''
+    Return (key, rate, burst) of the rate limit of an api, None without rate
+    limit. The limit is shared by all the apis with the same Seur account on
+    the host.
+    '''
+    rate = getattr(api, 'seur_rate_limit', None)
+    if not rate:
+        return None
+    key = '%s:%s:%s' % (api.username, api.seur_franchise, api.seur_ci)
+    return key, rate, getattr(api, 'seur_rate_burst', None)
+
+
+def seur_rate_wait(values):
+    '''
+    Wait for the rate limit before a Seur call
+    :param values: tuple of seur_rate_values, values are passed instead of
+        the api so the worker threads do not read the record
+    Return the waited seconds
+    '''
+    if not values:
+        return 0
+    waited = _limiter.acquire(*values)
+    if waited:
+        logger.debug('Seur rate limit waited %.3f seconds' % waited)
+    return waited
@@ -1,25 +1,38 @@
 # This file is part of the carrier_send_shipments module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+from collections import namedtuple
+from trytond.model import Model
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
-from seur.picking import Picking
+from trytond import backend
+from trytond.tools import grouped_slice
 from trytond.modules.carrier_send_shipments.tools import unaccent, unspaces
 from trytond.modules.carrier_send_shipments_seur.tools import set_seur_reference, \
-    seurbarcode
+    seurbarcodes
+from trytond.modules.carrier_send_shipments_seur.client import \
+    picking_dispatch, get_breaker, BREAKER_OPEN, SEUR_TIMEOUT
+from trytond.modules.carrier_send_shipments_seur.label import \
+    LabelRenderer, LabelWriter
+from trytond.modules.carrier_send_shipments_seur.timing import SeurTimer
+from trytond.modules.carrier_send_shipments_seur.profiling import \
+    seur_profile
 from base64 import decodestring
-import os
 import logging
-import tempfile
-import genshi
 
 __all__ = ['ShipmentOut']
 __metaclass__ = PoolMeta
 
 logger = logging.getLogger(__name__)
-offline_loader = genshi.template.TemplateLoader(
-    os.path.join(os.path.dirname(__file__), 'template'),
-    auto_reload=True)
+# shipment fields read by seur_picking_data
+SEUR_SHIPMENT_FIELDS = ['code', 'warehouse', 'delivery_address', 'customer',
+    'carrier', 'carrier_service', 'carrier_notes', 'number_packages',
+    'carrier_cashondelivery', 'carrier_cashondelivery_price', 'email',
+    'phone', 'mobile', 'carrier_tracking_ref', 'weight_uom']
+# values of seur_picking_data that only depend on the API, see get_seur_batch
+SeurBatch = namedtuple('SeurBatch', ['date', 'company_name',
+        'default_service', 'aviso_preaviso', 'aviso_reparto', 'aviso_email',
+        'aviso_sms', 'warehouses', 'weights', 'seur_zips', 'offline'])
 
 
 class ShipmentOut:
@@ -40,7 +53,168 @@ class ShipmentOut:
             })
 
     @staticmethod
-    def seur_picking_data(api, shipment, service, price=None, weight=False):
+    def seur_zip_keys(api, shipment):
+        '''
+        Seur Zip keys of a shipment
+        :param api: obj
+        :param shipment: obj
+        Return list of (codpos_zip, codpos_country) of warehouse and customer
+        '''
+        if shipment.warehouse.address:
+            waddress = shipment.warehouse.address
+        else:
+            waddress = api.company.party.addresses[0]
+        keys = []
+        if waddress.zip and waddress.country:
+            keys.append((unaccent(waddress.zip), waddress.country.code))
+        address = shipment.delivery_address
+        if address.zip and address.country:
+            customer_zip = unaccent(address.zip)
+            if address.country.code in ['PT']:
+                customer_zip = customer_zip.replace('-','')
+            keys.append((customer_zip, address.country.code))
+        return keys
+
+    @classmethod
+    def get_seur_zips(cls, api, shipments, offline=None):
+        '''
+        Seur Zips of a batch of shipments, resolved from the zip index
+        :param api: obj
+        :param shipments: list
+        :param offline: bol of shipments sent offline, api offline if None
+        Return dict of (codpos_zip, codpos_country): seur zip
+        '''
+        SeurZip = Pool().get('carrier.api.seur.zip')
+
+        if offline is None:
+            offline = api.seur_offline
+        # seur zips are only used to generate offline labels
+        if not offline:
+            return {}
+
+        index = SeurZip.get_index()
+        seur_zips = {}
+        for shipment in shipments:
+            for key in cls.seur_zip_keys(api, shipment):
+                if key in index:
+                    seur_zips[key] = index[key]
+        return seur_zips
+
+    @classmethod
+    def prefetch_seur(cls, api, shipments, weight=False):
+        '''
+        Read the relations used by seur_picking_data for a batch of shipments
+        with grouped reads, so the reads do not grow with the shipments
+        :param api: obj
+        :param shipments: list
+        :param weight: bol
+        Return the shipments browsed as one list
+        '''
+        pool = Pool()
+        Address = pool.get('party.address')
+
+        def fetch(records, names):
+            'Read names of records, return the related records by model'
+            related = {}
+            for record in records:
+                for name in names:
+                    value = getattr(record, name, None)
+                    if isinstance(value, Model) and value.id is not None:
+                        related.setdefault(value.__name__, set()).add(
+                            value.id)
+            return {m: pool.get(m).browse(list(ids))
+                for m, ids in related.items()}
+
+        shipments = cls.browse(shipments)
+        names = list(SEUR_SHIPMENT_FIELDS)
+        if weight:
+            names.append('weight_func')
+        if api.reference_origin:
+            names.append('origin')
+        related = fetch(shipments, names)
+
+        # delivery and warehouse addresses are read together
+        locations = related.pop('stock.location', [])
+        addresses = set(a.id for a in related.pop('party.address', []))
+        addresses.update(a.id for a in fetch(locations, ['address']).get(
+                'party.address', []))
+        countries = fetch(Address.browse(list(addresses)), ['country'])
+        fetch(countries.get('country.country', []), ['code'])
+        fetch(related.pop('carrier', []), ['service'])
+        fetch(related.pop('party.party', []), ['name'])
+        if api.reference_origin:
+            for model, records in related.items():
+                if model not in ('carrier.api.service', 'product.uom'):
+                    fetch(records, ['rec_name'])
+        return shipments
+
+    @classmethod
+    def get_seur_batch(cls, api, shipments, weight=False, seur_zips=None,
+            offline=None):
+        '''
+        Values of seur_picking_data that only depend on the API, the
+        warehouses or the weight units, computed once for a batch
+        :param api: obj
+        :param shipments: list
+        :param weight: bol
+        :param seur_zips: dict from get_seur_zips
+        :param offline: bol of shipments sent offline, api offline if None
+        Return SeurBatch
+        '''
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Date = pool.get('ir.date')
+        CarrierApi = pool.get('carrier.api')
+
+        if offline is None:
+            offline = api.seur_offline
+        if seur_zips is None:
+            seur_zips = cls.get_seur_zips(api, shipments, offline)
+
+        warehouses = {}
+        uoms = set()
+        if api.weight_unit:
+            uoms.add(api.weight_unit)
+        for shipment in shipments:
+            warehouse = shipment.warehouse
+            if warehouse.id not in warehouses:
+                if warehouse.address:
+                    waddress = warehouse.address
+                else:
+                    waddress = api.company.party.addresses[0]
+                warehouses[warehouse.id] = (
+                    unaccent(waddress.street),
+                    unaccent(waddress.city),
+                    unaccent(waddress.zip),
+                    waddress.country.code if waddress.country else None,
+                    )
+            weight_uom = getattr(shipment, 'weight_uom', None)
+            if weight_uom:
+                uoms.add(weight_uom)
+
+        weights = {}
+        if weight and api.weight_api_unit:
+            for uom in uoms:
+                weights[uom.id] = Uom.compute_qty(uom, weight,
+                    api.weight_api_unit)
+
+        return SeurBatch(
+            date=Date.today().strftime('%d/%m/%y'),
+            company_name=unaccent(api.company.party.name),
+            default_service=CarrierApi.get_default_carrier_service(api),
+            aviso_preaviso='S' if api.seur_aviso_preaviso else 'N',
+            aviso_reparto='S' if api.seur_aviso_reparto else 'N',
+            aviso_email='S' if api.seur_aviso_email else 'N',
+            aviso_sms='S' if api.seur_aviso_sms else 'N',
+            warehouses=warehouses,
+            weights=weights,
+            seur_zips=seur_zips,
+            offline=offline,
+            )
+
+    @classmethod
+    def seur_picking_data(cls, api, shipment, service, price=None, weight=False,
+            seur_zips=None, batch=None, offline=None):
         '''
         Seur Picking Data
         :param api: obj
@@ -48,12 +222,16 @@ class ShipmentOut:
         :param service: str
         :param price: string
         :param weight: bol
+        :param seur_zips: dict from get_seur_zips
+        :param batch: SeurBatch from get_seur_batch
+        :param offline: bol of shipments sent offline, api offline if None
+            (the offline of the batch when batch is set)
         Return data
         '''
-        pool = Pool()
-        Uom = pool.get('product.uom')
-        Date = pool.get('ir.date')
-        SeurZip = pool.get('carrier.api.seur.zip')
+        if batch is None:
+            batch = cls.get_seur_batch(api, [shipment], weight, seur_zips,
+                offline)
+        seur_zips = batch.seur_zips
 
         if api.reference_origin and hasattr(shipment, 'origin'):
             code = shipment.origin and shipment.origin.rec_name or shipment.code
@@ -68,15 +246,8 @@ class ShipmentOut:
         if not packages or packages == 0:
             packages = 1
 
-        if shipment.warehouse.address:
-            waddress = shipment.warehouse.address
-        else:
-            waddress = api.company.party.addresses[0]
-
-        warehouse_street = unaccent(waddress.street)
-        warehouse_city = unaccent(waddress.city)
-        warehouse_zip = unaccent(waddress.zip)
-        warehouse_country_code = waddress.country.code if waddress.country else None
+        (warehouse_street, warehouse_city, warehouse_zip,
+            warehouse_country_code) = batch.warehouses[shipment.warehouse.id]
 
         customer_name = unaccent(shipment.delivery_address.name
             or shipment.customer.name)
@@ -85,24 +256,8 @@ class ShipmentOut:
         customer_zip = unaccent(shipment.delivery_address.zip)
         customer_country_code = shipment.delivery_address.country.code
 
-        codpos_zips = set()
-        if warehouse_zip:
-            codpos_zips.add(warehouse_zip)
-        if customer_zip:
-            if customer_country_code in ['PT']:
-                customer_zip = customer_zip.replace('-','')
-            codpos_zips.add(customer_zip)
-        codpos_countries = set()
-        if warehouse_country_code:
-            codpos_countries.add(warehouse_country_code)
-        if customer_country_code:
-            codpos_countries.add(customer_country_code)
-
-        seur_zips = dict(((z.codpos_zip, z.codpos_country), z) for z in SeurZip.search([
-            ('codpos_zip', 'in', list(codpos_zips)),
-            ('codpos_country', 'in', list(codpos_countries)),
-            ('coddest_name', '!=', None),
-            ]))
+        if customer_zip and customer_country_code in ['PT']:
+            customer_zip = customer_zip.replace('-','')
 
         notes = '%(notes)s' \
             '%(name)s. %(street)s. %(zip)s %(city)s - %(country)s\n' % {
@@ -115,13 +270,13 @@ class ShipmentOut:
                 }
 
         data = {}
-        data['date'] = Date.today().strftime('%d/%m/%y')
-        data['company_name'] = unaccent(api.company.party.name)
+        data['date'] = batch.date
+        data['company_name'] = batch.company_name
         data['company_street'] = warehouse_street
 
         seur_company_zip = warehouse_zip
         seur_company_city = warehouse_city
-        if api.seur_offline and seur_zips.get((warehouse_zip, warehouse_country_code)):
+        if batch.offline and seur_zips.get((warehouse_zip, warehouse_country_code)):
             seur_zip = seur_zips[(warehouse_zip, warehouse_country_code)]
             seur_company_zip = seur_zip.codpos_code
             seur_company_city = seur_zip.codpos_city
@@ -148,11 +303,9 @@ class ShipmentOut:
                 sweight = 1.0
             if api.weight_api_unit:
                 if shipment.weight_uom:
-                    sweight = Uom.compute_qty(
-                        shipment.weight_uom, weight, api.weight_api_unit)
+                    sweight = batch.weights[shipment.weight_uom.id]
                 elif api.weight_unit:
-                    sweight = Uom.compute_qty(
-                        api.weight_unit, weight, api.weight_api_unit)
+                    sweight = batch.weights[api.weight_unit.id]
 
         data['total_kilos'] = str(sweight)
         data['peso_bulto'] = str(sweight)
@@ -169,7 +322,7 @@ class ShipmentOut:
         seur_customer_zip = customer_zip
         # seur_customer_city = customer_city
         seur_coddest_name = customer_city
-        if api.seur_offline and seur_zips.get((customer_zip, customer_country_code)):
+        if batch.offline and seur_zips.get((customer_zip, customer_country_code)):
             seur_zip = seur_zips[(customer_zip, customer_country_code)]
             seur_customer_zip = seur_zip.codpos_code
             # seur_customer_city = unaccent(seur_zip.codpos_city)
@@ -197,131 +350,252 @@ class ShipmentOut:
         data['cliente_telefono'] = unspaces(shipment.phone)
         data['sms_consignatario'] = unspaces(shipment.mobile)
         data['cliente_atencion'] = customer_name
-        data['aviso_preaviso'] = 'S' if api.seur_aviso_preaviso else 'N'
-        data['aviso_reparto'] = 'S' if api.seur_aviso_reparto else 'N'
-        data['aviso_email'] = 'S' if api.seur_aviso_email else 'N'
-        data['aviso_sms'] = 'S' if api.seur_aviso_sms else 'N'
+        data['aviso_preaviso'] = batch.aviso_preaviso
+        data['aviso_reparto'] = batch.aviso_reparto
+        data['aviso_email'] = batch.aviso_email
+        data['aviso_sms'] = batch.aviso_sms
         data['id_mercancia'] = '400' # TODO fixed ID mercancia
         return data
 
     @classmethod
     def send_seur(cls, api, shipments):
         'Send shipments out to seur'
-        if api.seur_offline:
-            return cls.send_seur_offline(api, shipments)
-        else:
-            return cls.send_seur_api(api, shipments)
+        dbname = Transaction().database.name
+        with seur_profile(dbname, 'send', api, len(shipments)):
+            if api.seur_offline or cls.seur_fallback_offline(api):
+                return cls.send_seur_offline(api, shipments)
+            else:
+                return cls.send_seur_api(api, shipments)
+
+    @staticmethod
+    def seur_fallback_offline(api):
+        'Send offline because the circuit breaker of the api is open'
+        if api.seur_breaker_offline and get_breaker(api).is_open():
+            logger.warning('Seur circuit breaker is open, send the '
+                'shipments offline')
+            return True
+        return False
 
     @classmethod
     def send_seur_api(cls, api, shipments):
         'Send shipments out to seur'
-        CarrierApi = Pool().get('carrier.api')
+        pool = Pool()
+        Label = pool.get('carrier.api.seur.label')
+        Retry = pool.get('carrier.api.seur.retry')
 
         references = []
-        labels = []
         errors = []
 
-        default_service = CarrierApi.get_default_carrier_service(api)
         dbname = Transaction().database.name
+        timer = SeurTimer('send_api', database=dbname, api=api.id,
+            shipments=len(shipments))
+
+        with timer.phase('prefetch'):
+            shipments = cls.prefetch_seur(api, shipments, api.weight)
+        with timer.phase('zip'):
+            seur_zips = cls.get_seur_zips(api, shipments)
+        with timer.phase('batch'):
+            batch = cls.get_seur_batch(api, shipments, api.weight, seur_zips)
+        default_service = batch.default_service
+
+        # picking data is computed in the main thread; only the Seur calls
+        # are dispatched to the pool of Picking sessions
+        to_send = []
+        for shipment in shipments:
+            service = shipment.carrier_service or shipment.carrier.service or default_service
+            if not service:
+                message = cls.raise_user_error('seur_add_services', {},
+                    raise_exception=False)
+                to_send.append((shipment, None, message))
+                continue
+
+            if not shipment.delivery_address.country:
+                message = cls.raise_user_error('seur_not_country', {},
+                    raise_exception=False)
+                to_send.append((shipment, None, message))
+                continue
 
-        seur_context = {}
-        if api.seur_pdf:
-            seur_context['pdf'] = True
-        with Picking(api.username, api.password, api.vat, api.seur_franchise, api.seur_seurid, \
-                api.seur_ci, api.seur_ccc, timeout=api.timeout, context=seur_context) as picking_api:
-            for shipment in shipments:
-                service = shipment.carrier_service or shipment.carrier.service or default_service
-                if not service:
-                    message = cls.raise_user_error('seur_add_services', {},
-                        raise_exception=False)
-                    errors.append(message)
-                    continue
-
-                if not shipment.delivery_address.country:
-                    message = cls.raise_user_error('seur_not_country', {},
-                        raise_exception=False)
-                    errors.append(message)
-                    continue
-
-                price = None
-                if shipment.carrier_cashondelivery:
-                    price = shipment.carrier_cashondelivery_price
-
-                data = cls.seur_picking_data(api, shipment, service, price, api.weight)
-                # Send shipment data to carrier
-                logger.info('Send SEUR API data: %s' % data)
-                reference, label, error = picking_api.create(data)
+            price = None
+            if shipment.carrier_cashondelivery:
+                price = shipment.carrier_cashondelivery_price
 
-                if reference:
+            with timer.phase('picking_data'):
+                data = cls.seur_picking_data(api, shipment, service, price,
+                    api.weight, batch=batch)
+            # Send shipment data to carrier
+            logger.info('Send SEUR API data: %s' % data)
+            to_send.append((shipment, service, data))
+
+        datas = [data for _, service, data in to_send if service]
+        with timer.phase('create', len(datas)):
+            results = iter(picking_dispatch(api, 'create', datas))
+
+        writer = LabelWriter(dbname, pdf=api.seur_pdf,
+            batch=api.seur_label_batch, retention=api.seur_label_retention)
+
+        # the labels of the shipments sent in background are not printed
+        printed = not Transaction().context.get('seur_retry')
+        to_store = []
+        to_offline = []
+        to_retry = []
+        for shipment, service, data in to_send:
+            if not service:
+                errors.append(data)
+                continue
+
+            reference, label, error = next(results)
+
+            # calls skipped by the circuit breaker are sent offline
+            if error == BREAKER_OPEN and api.seur_breaker_offline:
+                to_offline.append(shipment)
+                continue
+
+            if reference:
+                with timer.phase('write'):
                     cls.write([shipment], {
                         'carrier_tracking_ref': reference,
                         'carrier_service': service,
                         'carrier_delivery': True,
-                        'carrier_printed': True,
+                        'carrier_printed': printed,
                         'carrier_send_date': cls.get_carrier_date(),
                         'carrier_send_employee': cls.get_carrier_employee(),
                         })
-                    logger.info('Send shipment %s' % (shipment.code))
-                    references.append(shipment.code)
-                else:
-                    logger.error('Not send shipment %s.' % (shipment.code))
-
-                if label:
-                    if api.seur_pdf:
-                        with tempfile.NamedTemporaryFile(
-                                prefix='%s-seur-%s-' % (dbname, reference),
-                                suffix='.pdf', delete=False) as temp:
-                            temp.write(decodestring(label))
-                    else:
-                        with tempfile.NamedTemporaryFile(
-                                prefix='%s-seur-%s-' % (dbname, reference),
-                                suffix='.zpl', delete=False) as temp:
-                            temp.write(label.encode('utf-8'))
-                    logger.info('Generated tmp label %s' % (temp.name))
-                    temp.close()
-                    labels.append(temp.name)
+                logger.info('Send shipment %s' % (shipment.code))
+                references.append(shipment.code)
+            else:
+                logger.error('Not send shipment %s.' % (shipment.code))
+                # a call without answer is not retried, Seur may have
+                # created the shipment
+                if error != SEUR_TIMEOUT:
+                    to_retry.append((shipment, error or cls.raise_user_error(
+                                'seur_not_send', {
+                                    'name': shipment.rec_name,
+                                    }, raise_exception=False)))
+
+            if label:
+                if api.seur_pdf:
+                    label = decodestring(label)
                 else:
-                    message = cls.raise_user_error('seur_not_label', {
-                            'name': shipment.rec_name,
-                            }, raise_exception=False)
-                    errors.append(message)
-                    logger.error(message)
-
-                if error:
-                    message = cls.raise_user_error('seur_not_send_error', {
-                            'name': shipment.rec_name,
-                            'error': error,
-                            }, raise_exception=False)
-                    logger.error(message)
-                    errors.append(message)
-
+                    label = label.encode('utf-8')
+                with timer.phase('label_write'):
+                    writer.add(shipment.code, reference, label)
+                if reference:
+                    to_store.append((shipment, reference, 1, label, False))
+            else:
+                message = cls.raise_user_error('seur_not_label', {
+                        'name': shipment.rec_name,
+                        }, raise_exception=False)
+                errors.append(message)
+                logger.error(message)
+
+            if error:
+                message = cls.raise_user_error('seur_not_send_error', {
+                        'name': shipment.rec_name,
+                        'error': error,
+                        }, raise_exception=False)
+                logger.error(message)
+                errors.append(message)
+
+        with timer.phase('store', len(to_store)):
+            Label.store(api, to_store)
+        with timer.phase('retry', len(to_retry)):
+            Retry.enqueue(api, to_retry)
+
+        with timer.phase('label_write', 0):
+            labels = writer.close()
+        timer.close()
+
+        if to_offline:
+            logger.warning('Seur circuit breaker is open, send %s shipments '
+                'offline' % len(to_offline))
+            offline_references, offline_labels, offline_errors = \
+                cls.send_seur_offline(api, to_offline)
+            references += offline_references
+            labels += offline_labels
+            errors += offline_errors
         return references, labels, errors
 
+    @classmethod
+    def get_seur_sequence_numbers(cls, sequence, count):
+        '''
+        Reserve a block of Seur references from a sequence with one call
+        :param sequence: ir.sequence obj
+        :param count: int
+        Return list of int, the same numbers as count calls to get_id
+        '''
+        Sequence = Pool().get('ir.sequence')
+
+        if count <= 0:
+            return []
+        if sequence.type != 'incremental':
+            numbers = [Sequence.get_id(sequence.id) for _ in range(count)]
+        else:
+            transaction = Transaction()
+            cursor = transaction.connection.cursor()
+            if backend.name() == 'postgresql' and not Sequence._strict:
+                cursor.execute('SELECT nextval(\'"%s"\') '
+                    'FROM generate_series(1, %%s)'
+                    % sequence._sql_sequence_name, (count,))
+                values = sorted(r[0] for r in cursor.fetchall())
+            else:
+                # the update locks the sequence row until the commit
+                table = Sequence.__table__()
+                increment = sequence.number_increment
+                cursor.execute(*table.update([table.number_next_internal],
+                        [table.number_next_internal + count * increment],
+                        where=table.id == sequence.id))
+                cursor.execute(*table.select(table.number_next_internal,
+                        where=table.id == sequence.id))
+                number_next, = cursor.fetchone()
+                start = number_next - count * increment
+                # the row is updated behind the ORM, drop its cached values
+                # as write does so the next get_id reads the new number
+                transaction.counter += 1
+                for cache in transaction.cache.values():
+                    if Sequence.__name__ in cache:
+                        cache[Sequence.__name__].pop(sequence.id, None)
+                values = [start + i * increment for i in range(count)]
+            date = transaction.context.get('date')
+            prefix = Sequence._process(sequence.prefix, date=date)
+            suffix = Sequence._process(sequence.suffix, date=date)
+            numbers = ['%s%s%s' % (prefix, '%%0%sd' % sequence.padding % v,
+                    suffix) for v in values]
+        try:
+            return [int(n) for n in numbers]
+        except ValueError:
+            cls.raise_user_error('seur_reference_int')
+
     @classmethod
     def send_seur_offline(cls, api, shipments):
         'Send Seur Offline'
         pool = Pool()
         SeurOffline = pool.get('carrier.api.seur.offline')
-        Sequence = pool.get('ir.sequence')
-        CarrierApi = pool.get('carrier.api')
+        Label = pool.get('carrier.api.seur.label')
 
         # XML data will be created when send Seur email
 
-        tmpl = offline_loader.load('offline-label.zpl',
-            cls=genshi.template.text.NewTextTemplate)
+        renderer = LabelRenderer(api.seur_zpl_stored_format)
 
         dbname = Transaction().database.name
-        min_ref = api.seur_minimum_reference
-        max_ref = api.seur_maximun_reference
-        default_service = CarrierApi.get_default_carrier_service(api)
-        sequence_id = api.seur_reference.id
+        writer = LabelWriter(dbname, batch=api.seur_label_batch,
+            retention=api.seur_label_retention)
 
         references = []
-        labels = []
         errors = []
-
-        to_create = []
-        to_write = []
+        timer = SeurTimer('send_offline', database=dbname, api=api.id,
+            shipments=len(shipments))
+
+        with timer.phase('prefetch'):
+            shipments = cls.prefetch_seur(api, shipments, api.weight)
+        # also the shipments of an online api sent by the offline fallback
+        with timer.phase('zip'):
+            seur_zips = cls.get_seur_zips(api, shipments, offline=True)
+        with timer.phase('batch'):
+            batch = cls.get_seur_batch(api, shipments, api.weight, seur_zips,
+                offline=True)
+        default_service = batch.default_service
+
+        to_send = []
         for shipment in shipments:
             price = None
             if shipment.carrier_cashondelivery:
@@ -330,7 +604,9 @@ class ShipmentOut:
             service = shipment.carrier_service or shipment.carrier.service \
                 or default_service
 
-            vals = cls.seur_picking_data(api, shipment, service, price, api.weight)
+            with timer.phase('picking_data'):
+                vals = cls.seur_picking_data(api, shipment, service, price,
+                    api.weight, batch=batch)
 
             if vals['clave_portes'] == 'D':
                 vals['clave_portes'] = 'P.Debidos'
@@ -339,35 +615,51 @@ class ShipmentOut:
                 vals['clave_portes'] = 'P.Pagados'
             if vals['clave_reembolso'] == 'F':
                 vals['clave_reembolso'] = 'R'
-
+            to_send.append((shipment, vals))
+
+        # reserve the references of all packages of each shard in one
+        # sequence call
+        shards = {}
+        for shipment, vals in to_send:
+            shard = api.get_seur_shard(shipment.warehouse)
+            shards.setdefault(shard, 0)
+            shards[shard] += vals['total_bultos']
+        numbers = {}
+        for shard, count in shards.items():
+            with timer.phase('sequence', count):
+                numbers[shard] = iter(
+                    cls.get_seur_sequence_numbers(shard[0], count))
+
+        # the labels of the shipments sent in background are not printed
+        printed = not Transaction().context.get('seur_retry')
+        to_create = []
+        to_write = []
+        to_store = []
+        for shipment, vals in to_send:
+            shard = api.get_seur_shard(shipment.warehouse)
+            _, min_ref, max_ref = shard
             seur_references = []
             for i in range(0, vals['total_bultos']):
-                try:
-                    reference = int(Sequence.get_id(sequence_id))
-                except:
-                    cls.raise_user_error('seur_reference_int')
-                seur_reference = str(set_seur_reference(min_ref, max_ref, reference))
-                seur_references.append(seur_reference)
-
-                barcode = seurbarcode(
-                    from_zip=shipment.warehouse.address.zip,
-                    to_zip=vals['seur_codpos_code'],
-                    reference=seur_reference,
-                    transport=1) # TODO transport type is fixed to 1
-                vals['barcode'] = barcode
-                vals['barcode_compact'] = barcode.replace (' ', '')
+                reference = next(numbers[shard])
+                seur_references.append(
+                    str(set_seur_reference(min_ref, max_ref, reference)))
+
+            barcodes = seurbarcodes(
+                from_zip=shipment.warehouse.address.zip,
+                to_zip=vals['seur_codpos_code'],
+                references=seur_references,
+                transport=1) # TODO transport type is fixed to 1
+            for i, seur_reference in enumerate(seur_references):
+                vals['barcode'], vals['barcode_compact'] = barcodes[i]
                 vals['bulto'] = i + 1
 
-                zpl = tmpl.generate(**vals).render()
-                with tempfile.NamedTemporaryFile(
-                        prefix='%s-seur-%s-' % (dbname, seur_reference),
-                        suffix='.zpl', delete=False) as temp:
-                    temp.write(zpl.encode('utf-8'))
-
-                logger.info(
-                    'Generated tmp label %s' % (temp.name))
-                labels.append(temp.name)
-                temp.close()
+                with timer.phase('render'):
+                    zpl = renderer.render_label(vals)
+                with timer.phase('label_write'):
+                    writer.add(shipment.code, seur_reference,
+                        renderer.prepare(zpl).encode('utf-8'))
+                to_store.append((shipment, seur_reference, i + 1,
+                        zpl.encode('utf-8'), renderer.stored_format))
 
             to_create.append({
                 'api': api,
@@ -378,102 +670,186 @@ class ShipmentOut:
             to_write.extend(([shipment], {
                 'carrier_tracking_ref': ','.join(seur_references),
                 'carrier_delivery': True,
-                'carrier_printed': True,
+                'carrier_printed': printed,
                 'carrier_send_date': cls.get_carrier_date(),
                 'carrier_send_employee': cls.get_carrier_employee(),
                 }))
             references.extend(seur_references)
 
-        if to_write:
-            cls.write(*to_write)
-        if to_create:
-            with Transaction().set_user(0):
-                SeurOffline.create(to_create)
-
+        with timer.phase('write', len(to_create)):
+            if to_write:
+                cls.write(*to_write)
+            if to_create:
+                with Transaction().set_user(0):
+                    SeurOffline.create(to_create)
+        with timer.phase('store', len(to_store)):
+            Label.store(api, to_store, offline=True)
+
+        with timer.phase('label_write', 0):
+            labels = writer.close()
+        timer.close()
         return references, labels, errors
 
     @classmethod
     def print_labels_seur(cls, api, shipments):
         'Print Seur Labels'
-        if api.seur_offline:
-            return cls.print_labels_seur_offline(api, shipments)
-        else:
-            return cls.print_labels_seur_api(api, shipments)
+        SeurOffline = Pool().get('carrier.api.seur.offline')
+
+        dbname = Transaction().database.name
+        with seur_profile(dbname, 'print', api, len(shipments)):
+            if api.seur_offline:
+                return cls.print_labels_seur_offline(api, shipments)
+
+            # the shipments sent by the offline fallback have offline labels
+            offline = set()
+            for sub_ids in grouped_slice([s.id for s in shipments]):
+                offline.update(o.shipment.id for o in SeurOffline.search([
+                            ('api', '=', api),
+                            ('shipment', 'in', list(sub_ids)),
+                            ]))
+            labels = []
+            if offline:
+                labels += cls.print_labels_seur_offline(api,
+                    [s for s in shipments if s.id in offline])
+            online = [s for s in shipments if s.id not in offline]
+            if online:
+                labels += cls.print_labels_seur_api(api, online)
+            return labels
 
     @classmethod
     def print_labels_seur_api(cls, api, shipments):
         '''
         Get Seur labels from Shipment Out
         '''
-        CarrierApi = Pool().get('carrier.api')
+        pool = Pool()
+        Label = pool.get('carrier.api.seur.label')
 
-        default_service = CarrierApi.get_default_carrier_service(api)
         dbname = Transaction().database.name
 
-        labels = []
         errors = []
+        writer = LabelWriter(dbname, pdf=api.seur_pdf,
+            batch=api.seur_label_batch, retention=api.seur_label_retention)
+        timer = SeurTimer('print_api', database=dbname, api=api.id,
+            shipments=len(shipments))
+
+        # stored labels are reprinted without calling Seur
+        with timer.phase('stored_labels'):
+            stored = Label.get_labels(api, shipments)
+        with timer.phase('prefetch'):
+            missing = cls.prefetch_seur(api,
+                [s for s in shipments if s.id not in stored], api.weight)
+
+        with timer.phase('zip'):
+            seur_zips = cls.get_seur_zips(api, missing)
+        with timer.phase('batch'):
+            batch = cls.get_seur_batch(api, missing, api.weight, seur_zips)
+        default_service = batch.default_service
+
+        to_label = []
+        for shipment in missing:
+            service = shipment.carrier_service or default_service
+            if not service:
+                message = 'Add %s service or configure a default API Seur service.' % (shipment.code)
+                errors.append(message)
+                logger.error(message)
+                continue
+
+            if not shipment.delivery_address.country:
+                message = 'Add %s a country.' % (shipment.code)
+                errors.append(message)
+                logger.error(message)
+                continue
 
-        seur_context = {}
-        if api.seur_pdf:
-            seur_context['pdf'] = True
-        with Picking(api.username, api.password, api.vat, api.seur_franchise, api.seur_seurid, \
-                api.seur_ci, api.seur_ccc, timeout=api.timeout, context=seur_context) as picking_api:
-            for shipment in shipments:
-                service = shipment.carrier_service or default_service
-                if not service:
-                    message = 'Add %s service or configure a default API Seur service.' % (shipment.code)
-                    errors.append(message)
-                    logger.error(message)
-                    continue
-
-                if not shipment.delivery_address.country:
-                    message = 'Add %s a country.' % (shipment.code)
-                    errors.append(message)
-                    logger.error(message)
-                    continue
-
-                price = None
-                if shipment.carrier_cashondelivery:
-                    price = shipment.carrier_cashondelivery_price
-
-                data = cls.seur_picking_data(api, shipment, service, price, api.weight)
-                label = picking_api.label(data)
-
-                if label:
-                    if api.seur_pdf:
-                        with tempfile.NamedTemporaryFile(
-                                prefix='%s-seur-%s-' % (dbname, shipment.carrier_tracking_ref),
-                                suffix='.pdf', delete=False) as temp:
-                            temp.write(decodestring(label.encode('utf-8')))
-                    else:
-                        with tempfile.NamedTemporaryFile(
-                                prefix='%s-seur-%s-' % (dbname, shipment.carrier_tracking_ref),
-                                suffix='.zpl', delete=False) as temp:
-                            temp.write(label.encode('utf-8'))
-                    logger.info(
-                        'Generated tmp label %s' % (temp.name))
-                    temp.close()
-                    labels.append(temp.name)
+            price = None
+            if shipment.carrier_cashondelivery:
+                price = shipment.carrier_cashondelivery_price
+
+            with timer.phase('picking_data'):
+                data = cls.seur_picking_data(api, shipment, service,
+                    price, api.weight, batch=batch)
+            to_label.append((shipment, data))
+
+        with timer.phase('label', len(to_label)):
+            results = picking_dispatch(api, 'label',
+                [data for _, data in to_label])
+
+        labels = {}
+        to_store = []
+        for (shipment, _), label in zip(to_label, results):
+            if label:
+                if api.seur_pdf:
+                    label = decodestring(label.encode('utf-8'))
                 else:
-                    message = 'Not label %s shipment available from Seur.' % (shipment.code)
-                    errors.append(message)
-                    logger.error(message)
+                    label = label.encode('utf-8')
+                labels[shipment.id] = label
+                if shipment.carrier_tracking_ref:
+                    to_store.append((shipment,
+                            shipment.carrier_tracking_ref, 1, label, False))
+            else:
+                message = 'Not label %s shipment available from Seur.' % (shipment.code)
+                errors.append(message)
+                logger.error(message)
 
+        with timer.phase('label_write', len(shipments)):
+            for shipment in shipments:
+                if shipment.id in stored:
+                    for label in stored[shipment.id]:
+                        writer.add(shipment.code, label.reference,
+                            bytes(label.data))
+                elif shipment.id in labels:
+                    writer.add(shipment.code, shipment.carrier_tracking_ref,
+                        labels[shipment.id])
+
+        with timer.phase('store', len(to_store)):
+            Label.store(api, to_store)
+        with timer.phase('label_write', 0):
+            labels = writer.close()
+        timer.close()
         return labels
 
     @classmethod
     def print_labels_seur_offline(cls, api, shipments):
         'Print Label Seur Offline'
-        CarrierApi = Pool().get('carrier.api')
-
-        tmpl = offline_loader.load('offline-label.zpl',
-            cls=genshi.template.text.NewTextTemplate)
+        pool = Pool()
+        Label = pool.get('carrier.api.seur.label')
 
         dbname = Transaction().database.name
-        default_service = CarrierApi.get_default_carrier_service(api)
-
-        labels = []
+        timer = SeurTimer('print_offline', database=dbname, api=api.id,
+            shipments=len(shipments))
+
+        # stored labels are reprinted without rendering the template
+        with timer.phase('stored_labels'):
+            stored = Label.get_labels(api, shipments, offline=True)
+        renderer = LabelRenderer(api.seur_zpl_stored_format
+            or any(l.stored_format for labels in stored.values()
+                for l in labels))
+
+        writer = LabelWriter(dbname, batch=api.seur_label_batch,
+            retention=api.seur_label_retention)
+
+        with timer.phase('prefetch'):
+            missing = cls.prefetch_seur(api,
+                [s for s in shipments if s.id not in stored], api.weight)
+            missing = dict((s.id, s) for s in missing)
+        with timer.phase('zip'):
+            seur_zips = cls.get_seur_zips(api, list(missing.values()),
+                offline=True)
+        with timer.phase('batch'):
+            batch = cls.get_seur_batch(api, list(missing.values()),
+                api.weight, seur_zips, offline=True)
+        default_service = batch.default_service
+
+        to_store = []
         for shipment in shipments:
+            if shipment.id in stored:
+                with timer.phase('label_write', len(stored[shipment.id])):
+                    for label in stored[shipment.id]:
+                        zpl = bytes(label.data).decode('utf-8')
+                        writer.add(shipment.code, label.reference,
+                            renderer.prepare(zpl).encode('utf-8'))
+                continue
+            shipment = missing[shipment.id]
+
             from_zip = shipment.warehouse.address.zip
 
             price = None
@@ -483,7 +859,9 @@ class ShipmentOut:
             service = shipment.carrier_service or shipment.carrier.service \
                 or default_service
 
-            vals = cls.seur_picking_data(api, shipment, service, price, api.weight)
+            with timer.phase('picking_data'):
+                vals = cls.seur_picking_data(api, shipment, service, price,
+                    api.weight, batch=batch)
 
             if vals['clave_portes'] == 'D':
                 vals['clave_portes'] = 'P.Debidos'
@@ -493,27 +871,27 @@ class ShipmentOut:
             if vals['clave_reembolso'] == 'F':
                 vals['clave_reembolso'] = 'R'
 
-            bulto = 1
-            for seur_reference in shipment.carrier_tracking_ref.split(','):
-                barcode = seurbarcode(
-                    from_zip=from_zip,
-                    to_zip=vals['seur_codpos_code'],
-                    reference=seur_reference,
-                    transport=1) # TODO transport type is fixed to 1
-                vals['barcode'] = barcode
-                vals['barcode_compact'] = barcode.replace (' ', '')
-                vals['bulto'] = bulto
-                bulto += 1
-
-                zpl = tmpl.generate(**vals).render()
-                with tempfile.NamedTemporaryFile(
-                        prefix='%s-seur-%s-' % (dbname, seur_reference),
-                        suffix='.zpl', delete=False) as temp:
-                    temp.write(zpl.encode('utf-8'))
-
-                logger.info(
-                    'Generated tmp label %s' % (temp.name))
-                labels.append(temp.name)
-                temp.close()
+            seur_references = shipment.carrier_tracking_ref.split(',')
+            barcodes = seurbarcodes(
+                from_zip=from_zip,
+                to_zip=vals['seur_codpos_code'],
+                references=seur_references,
+                transport=1) # TODO transport type is fixed to 1
+            for i, seur_reference in enumerate(seur_references):
+                vals['barcode'], vals['barcode_compact'] = barcodes[i]
+                vals['bulto'] = i + 1
 
+                with timer.phase('render'):
+                    zpl = renderer.render_label(vals)
+                with timer.phase('label_write'):
+                    writer.add(shipment.code, seur_reference,
+                        renderer.prepare(zpl).encode('utf-8'))
+                to_store.append((shipment, seur_reference, i + 1,
+                        zpl.encode('utf-8'), renderer.stored_format))
+
+        with timer.phase('store', len(to_store)):
+            Label.store(api, to_store, offline=True)
+        with timer.phase('label_write', 0):
+            labels = writer.close()
+        timer.close()
         return labels
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the Seur send, print and manifest paths against the local
+Seur stand-in (seur_fake)
+
+    python -m trytond.modules.carrier_send_shipments_seur.tests.benchmark_seur \\
+        --sizes 10,1000,10000 --latency 0.05 --jitter 0.05 --error-rate 0.01
+
+The module is installed in the test database (DB_NAME environment variable,
+see trytond.tests.test_tryton) and each run creates its shipments in a
+transaction that is rolled back. The paths run the methods of the module
+(ShipmentOut send_seur_api, print_labels_seur_api and
+print_labels_seur_offline) with seur Picking replaced by FakePicking on the
+shipments in batches of --batch-size, and report the throughput and the
+p50/p95/p99 latency of a batch. The manifest path calls carrier.manifest
+get_manifest_seur once per run.
+'''
+from __future__ import print_function
+import argparse
+import datetime
+import shutil
+import tempfile
+import time
+
+from trytond.tests.test_tryton import install_module, DB_NAME, USER, \
+    CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.carrier_send_shipments_seur.tests.seur_fake import \
+    fake_picking
+
+PATHS = ['send', 'print', 'print_offline', 'manifest']
+
+
+def percentile(values, percent):
+    'Nearest-rank percentile of values'
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def create_api(company, options):
+    'Seur API of the benchmark'
+    pool = Pool()
+    CarrierApi = pool.get('carrier.api')
+    Sequence = pool.get('ir.sequence')
+
+    sequence, = Sequence.search([('code', '=', 'carrier.api.seur')])
+    api, = CarrierApi.create([{
+                'name': 'Seur',
+                'method': 'seur',
+                'company': company.id,
+                'vat': '123456',
+                'url': 'http://cit.seur.com/CIT-war/services/',
+                'username': 'user',
+                'password': 'password',
+                'seur_franchise': '123',
+                'seur_seurid': '123',
+                'seur_ci': '123',
+                'seur_ccc': '123',
+                'seur_workers': options.workers,
+                'seur_pdf': options.pdf,
+                'seur_label_batch': options.batch,
+                'seur_zpl_stored_format': options.stored_format,
+                'seur_reference': sequence.id,
+                'seur_minimum_reference': 4900000,
+                'seur_maximun_reference': 4920999,
+                'seur_email': 'seur@example.com',
+                'seur_filename': 'benchmark',
+                'services': [('create', [{
+                                'code': '031',
+                                'name': 'Seur 24',
+                                }])],
+                }])
+    CarrierApi.write([api], {'default_service': api.services[0].id})
+    return api
+
+
+def create_shipments(company, api, size, tracking=True):
+    '''
+    Shipments of size to a customer in another province, with tracking
+    references to print them
+    '''
+    pool = Pool()
+    Country = pool.get('country.country')
+    Party = pool.get('party.party')
+    Address = pool.get('party.address')
+    Location = pool.get('stock.location')
+    ShipmentOut = pool.get('stock.shipment.out')
+
+    country, = Country.create([{'name': 'Spain', 'code': 'ES'}])
+    warehouse, = Location.search([('code', '=', 'WH')])
+    address, = Address.create([{
+                'party': company.party.id,
+                'street': 'Street 1',
+                'zip': '08720',
+                'city': 'Vilafranca del Penedes',
+                'country': country.id,
+                }])
+    Location.write([warehouse], {'address': address.id})
+    customer, = Party.create([{
+                'name': 'Customer',
+                'addresses': [('create', [{
+                                'street': 'Street 2',
+                                'zip': '19005',
+                                'city': 'Guadalajara',
+                                'country': country.id,
+                                }])],
+                }])
+    return ShipmentOut.create([{
+                'customer': customer.id,
+                'delivery_address': customer.addresses[0].id,
+                'warehouse': warehouse.id,
+                'carrier_service': api.services[0].id,
+                'carrier_tracking_ref': (str(4900000 + i) if tracking
+                    else None),
+                } for i in range(size)])
+
+
+def prepare(path, api):
+    '''
+    Return the function of path called with a batch of shipments, what it
+    needs is set up here out of the measured time
+    '''
+    pool = Pool()
+    CarrierApi = pool.get('carrier.api')
+    ShipmentOut = pool.get('stock.shipment.out')
+
+    if path == 'send':
+        return lambda shipments: ShipmentOut.send_seur_api(api, shipments)
+    elif path == 'print':
+        return lambda shipments: ShipmentOut.print_labels_seur_api(api,
+            shipments)
+    elif path == 'print_offline':
+        CarrierApi.write([api], {'seur_offline': True})
+        api = CarrierApi(api.id)
+        return lambda shipments: ShipmentOut.print_labels_seur_offline(api,
+            shipments)
+    elif path == 'manifest':
+        Manifest = pool.get('carrier.manifest', type='wizard')
+        session_id, _, _ = Manifest.create()
+        wizard = Manifest(session_id)
+        today = datetime.date.today()
+        return lambda shipments: wizard.get_manifest_seur(api, today, today)
+    raise ValueError('Unknown path %s' % path)
+
+
+def run(path, size, options, fake_options):
+    '''
+    Run a path for size shipments in a transaction that is rolled back
+    Return dict with the throughput and the batch latency percentiles
+    '''
+    directory = tempfile.mkdtemp(prefix='seur-benchmark-')
+    tempdir = tempfile.tempdir
+    tempfile.tempdir = directory
+    timings = []
+    try:
+        with Transaction().start(DB_NAME, USER, context=CONTEXT) \
+                as transaction:
+            try:
+                company = create_company()
+                with set_company(company):
+                    api = create_api(company, options)
+                    shipments = create_shipments(company, api, size,
+                        tracking=path != 'send')
+                    call = prepare(path, api)
+                    # the manifest is of the day, not of the shipments
+                    if path == 'manifest':
+                        batches = [shipments]
+                    else:
+                        batches = [shipments[i:i + options.batch_size]
+                            for i in range(0, size, options.batch_size)]
+                    with fake_picking(**fake_options) as picking:
+                        start = time.time()
+                        for batch in batches:
+                            batch_start = time.time()
+                            call(batch)
+                            timings.append(time.time() - batch_start)
+                        elapsed = time.time() - start
+                        calls = list(picking.calls)
+            finally:
+                transaction.rollback()
+    finally:
+        tempfile.tempdir = tempdir
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'path': path,
+        'size': size,
+        'batches': len(timings),
+        'errors': len([c for c in calls if c[2]]),
+        'elapsed': elapsed,
+        'throughput': size / elapsed if elapsed else 0.0,
+        'p50': percentile(timings, 50),
+        'p95': percentile(timings, 95),
+        'p99': percentile(timings, 99),
+        }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Seur benchmark')
+    parser.add_argument('--sizes', default='10,1000,10000',
+        help='comma separated number of shipments')
+    parser.add_argument('--paths', default=','.join(PATHS),
+        help='comma separated paths (%s)' % ', '.join(PATHS))
+    parser.add_argument('--latency', type=float, default=0.01,
+        help='seconds of each Seur call')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='maximum random seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+        help='ratio of failed Seur calls')
+    parser.add_argument('--label-size', type=int, default=2048,
+        help='bytes of each label')
+    parser.add_argument('--batch-size', type=int, default=100,
+        help='shipments of each call of the send and print paths')
+    parser.add_argument('--workers', type=int, default=4,
+        help='Seur sessions of the send path')
+    parser.add_argument('--pdf', action='store_true', help='PDF labels')
+    parser.add_argument('--batch', action='store_true',
+        help='write the labels of a batch to one file')
+    parser.add_argument('--stored-format', action='store_true',
+        help='ZPL stored format for the offline labels')
+    parser.add_argument('--seed', type=int, default=None)
+    options = parser.parse_args(args)
+
+    fake_options = {
+        'latency': options.latency,
+        'jitter': options.jitter,
+        'error_rate': options.error_rate,
+        'label_size': options.label_size,
+        'seed': options.seed,
+        }
+
+    install_module('carrier_send_shipments_seur')
+
+    print('%-14s %7s %7s %7s %9s %11s %9s %9s %9s' % ('path', 'size',
+            'batches', 'errors', 'time (s)', 'shipments/s', 'p50 (ms)',
+            'p95 (ms)', 'p99 (ms)'))
+    results = []
+    for path in options.paths.split(','):
+        for size in options.sizes.split(','):
+            result = run(path, int(size), options, fake_options)
+            results.append(result)
+            print('%-14s %7d %7d %7d %9.2f %11.1f %9.2f %9.2f %9.2f' % (
+                    result['path'], result['size'], result['batches'],
+                    result['errors'],
+                    result['elapsed'], result['throughput'],
+                    result['p50'] * 1000, result['p95'] * 1000,
+                    result['p99'] * 1000))
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Local stand-in of the Seur Picking web service
+
+The fake answers the create, label and manifiesto calls of
+seur.picking.Picking without network, with configurable latency, error rate
+and label size, so the send, print and manifest paths can be measured.
+FakeSMTP is the stand-in of the SMTP server of the offline mails.
+'''
+import base64
+import errno
+import random
+import smtplib
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['FakePicking', 'FakeApi', 'fake_picking', 'picking_data',
+    'FakeSMTP', 'fake_smtp']
+
+# modules that hold a reference to seur Picking
+PICKING_MODULES = [
+    'trytond.modules.carrier_send_shipments_seur.client',
+    ]
+
+
+class FakePicking(object):
+    'Seur Picking with configurable latency, error rate and label size'
+    latency = 0.0
+    jitter = 0.0
+    error_rate = 0.0
+    exception_rate = 0.0
+    label_size = 2048
+    seed = None
+
+    _lock = threading.Lock()
+    _reference = 8200000
+    _random = random.Random()
+    calls = []
+    sessions = 0
+
+    def __init__(self, username, password, vat, franchise, seurid, ci, ccc,
+            timeout=None, context=None):
+        self.username = username
+        self.timeout = timeout
+        self.context = context or {}
+        with self._lock:
+            FakePicking.sessions += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    @classmethod
+    def reset(cls, **options):
+        'Set the options of the fake and clear its calls and sessions'
+        for name, value in options.items():
+            if not hasattr(cls, name):
+                raise AttributeError('Unknown fake option %s' % name)
+            setattr(cls, name, value)
+        cls._random.seed(cls.seed)
+        cls.calls = []
+        cls.sessions = 0
+
+    def _call(self, method):
+        '''
+        Wait the latency of a call, return True if the call fails
+        Raise socket.timeout when the latency is over the session timeout
+        and socket.error for the calls of the exception rate
+        '''
+        start = time.time()
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            reset = self._random.random() < self.exception_rate
+        timeout = self.timeout and delay > self.timeout
+        if timeout:
+            delay = self.timeout
+        if delay:
+            time.sleep(delay)
+        with self._lock:
+            self.calls.append((method, time.time() - start,
+                    failed or timeout or reset))
+        if timeout:
+            raise socket.timeout('timed out')
+        if reset:
+            raise socket.error(errno.ECONNRESET, 'Fake connection reset')
+        return failed
+
+    def _label(self, data):
+        label = (u'^XA^FO50,50^FD%s^FS' % data.get('referencia_expedicion',
+                '')).ljust(self.label_size - 3, u'0') + u'^XZ'
+        if self.context.get('pdf'):
+            return base64.b64encode(label.encode('utf-8')).decode('ascii')
+        return label
+
+    def create(self, data):
+        if self._call('create'):
+            return None, None, 'Fake Seur error'
+        with self._lock:
+            FakePicking._reference += 1
+            reference = str(FakePicking._reference)
+        return reference, self._label(data), None
+
+    def label(self, data):
+        if self._call('label'):
+            return None
+        return self._label(data)
+
+    def manifiesto(self, data):
+        if self._call('manifiesto'):
+            return None
+        return base64.b64encode(b'%PDF-1.4 fake manifest ' + b'0'
+            * self.label_size).decode('ascii')
+
+
+class FakeApi(object):
+    'carrier.api values used by the Seur client'
+
+    def __init__(self, **values):
+        self.username = 'user'
+        self.password = 'password'
+        self.vat = 'B00000000'
+        self.seur_franchise = '08'
+        self.seur_seurid = '1'
+        self.seur_ci = '1'
+        self.seur_ccc = '1'
+        self.timeout = 30
+        self.seur_pdf = False
+        self.seur_workers = 4
+        self.seur_offline = False
+        self.seur_label_batch = False
+        self.seur_label_retention = None
+        self.seur_zpl_stored_format = False
+        for name, value in values.items():
+            setattr(self, name, value)
+
+
+@contextmanager
+def fake_picking(**options):
+    '''
+    Replace seur Picking by FakePicking in the module
+    :param options: FakePicking options (latency, jitter, error_rate,
+        exception_rate, label_size, seed)
+    '''
+    import importlib
+    from trytond.modules.carrier_send_shipments_seur.client import \
+        session_pool
+    FakePicking.reset(**options)
+    # pooled sessions must not be shared with the real Picking
+    session_pool.clear()
+    patched = []
+    for name in PICKING_MODULES:
+        module = importlib.import_module(name)
+        patched.append((module, module.Picking))
+        module.Picking = FakePicking
+    try:
+        yield FakePicking
+    finally:
+        for module, picking in patched:
+            module.Picking = picking
+        session_pool.clear()
+        FakePicking.reset(latency=0.0, jitter=0.0, error_rate=0.0,
+            exception_rate=0.0, label_size=2048, seed=None)
+
+
+class FakeSMTP(object):
+    'SMTP connection that keeps the sent messages or refuses them'
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.messages = []
+        self.connections = 0
+
+    def sendmail(self, from_, recipients, message):
+        if self.fail:
+            raise smtplib.SMTPDataError(554, 'Fake SMTP error')
+        self.messages.append((from_, recipients, message))
+
+    def quit(self):
+        pass
+
+
+@contextmanager
+def fake_smtp(SMTPServer, fail=False):
+    '''
+    Replace the SMTP connection of the smtp.server model by FakeSMTP
+    :param SMTPServer: smtp.server model
+    :param fail: bool to refuse the messages
+    '''
+    smtp = FakeSMTP(fail=fail)
+
+    def get_smtp_server(self):
+        smtp.connections += 1
+        return smtp
+    get_smtp_server_orig = SMTPServer.get_smtp_server
+    SMTPServer.get_smtp_server = get_smtp_server
+    try:
+        yield smtp
+    finally:
+        SMTPServer.get_smtp_server = get_smtp_server_orig
+
+
+def picking_data(number):
+    'Synthetic picking data with the fields of seur_picking_data'
+    code = 'OUT%06d' % number
+    return {
+        'date': time.strftime('%d/%m/%y'),
+        'company_name': 'Company',
+        'company_street': 'Street 1',
+        'company_zip': '08720',
+        'company_city': 'Vilafranca del Penedes',
+        'servicio': '31',
+        'total_bultos': 1,
+        'observaciones': 'Customer %s. Street 2. 19005 Guadalajara - ES\n'
+            % number,
+        'referencia_expedicion': code,
+        'ref_bulto': code,
+        'clave_portes': 'F',
+        'clave_reembolso': ' ',
+        'valor_reembolso': '0',
+        'total_kilos': '1.0',
+        'peso_bulto': '1.0',
+        'cliente_nombre': 'Customer %s' % number,
+        'cliente_direccion': 'Street 2',
+        'cliente_cpostal': '19005',
+        'cliente_poblacion': 'Guadalajara',
+        'cliente_pais': 'ES',
+        'seur_coddest_name': 'GUADALAJARA',
+        'seur_codpos_code': '19005',
+        'product': '2',
+        'product_short_name': 'ESTD',
+        'service_short_name': '*B2C',
+        'cliente_email': 'customer@example.com',
+        'cliente_telefono': '600000000',
+        'sms_consignatario': '600000000',
+        'cliente_atencion': 'Customer %s' % number,
+        'aviso_preaviso': 'N',
+        'aviso_reparto': 'N',
+        'aviso_email': 'N',
+        'aviso_sms': 'N',
+        'id_mercancia': '400',
+        }
@@ -1,14 +1,203 @@
 # This file is part of the carrier_send_shipments_seur module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import os
+import shutil
+import datetime
+import tempfile
+import threading
 import unittest
 import doctest
+from base64 import b64decode
+from decimal import Decimal
+from xml.etree import ElementTree
+from contextlib import contextmanager
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond.pool import Pool
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.modules.company.tests import create_company, set_company
+from trytond.transaction import Transaction
 from trytond.modules.carrier_send_shipments_seur.tools import set_seur_reference, \
-    seurbarcode
+    seurbarcode, seurbarcodes, seur_reference_overlaps, seur_backoff
+from trytond.modules.carrier_send_shipments_seur.label import ZPLTemplate, \
+    LabelWriter
+from trytond.modules.carrier_send_shipments_seur.timing import \
+    SeurTimer, get_timings
+from trytond.modules.carrier_send_shipments_seur.ratelimit import \
+    RateLimiter
+from trytond.modules.carrier_send_shipments_seur.client import \
+    picking_dispatch, SessionPool, CircuitBreaker, \
+    get_breaker, BREAKER_OPEN, SEUR_TIMEOUT
+from trytond.modules.carrier_send_shipments_seur.tests.seur_fake import \
+    FakeApi, fake_picking, picking_data, fake_smtp
+
+
+def create_api(**values):
+    'Create a Seur carrier API'
+    CarrierApi = Pool().get('carrier.api')
+    api_values = {
+        'name': 'Seur',
+        'method': 'seur',
+        'vat': '123456',
+        'url': 'http://cit.seur.com/CIT-war/services/',
+        'username': 'user',
+        'password': 'password',
+        'seur_franchise': '123',
+        'seur_seurid': '123',
+        'seur_ci': '123',
+        'seur_ccc': '123',
+        }
+    api_values.update(values)
+    api, = CarrierApi.create([api_values])
+    return api
+
+
+def create_shipments(company, api, count, **values):
+    '''
+    Create count shipments from the warehouse to a customer, with a carrier
+    and a service of api
+    '''
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Template = pool.get('product.template')
+    Party = pool.get('party.party')
+    Address = pool.get('party.address')
+    Country = pool.get('country.country')
+    Carrier = pool.get('carrier')
+    CarrierApi = pool.get('carrier.api')
+    Location = pool.get('stock.location')
+    ShipmentOut = pool.get('stock.shipment.out')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    template, = Template.create([{
+                'name': 'Delivery',
+                'type': 'service',
+                'default_uom': unit.id,
+                'list_price': Decimal('10'),
+                'cost_price': Decimal('2'),
+                'products': [('create', [{}])],
+                }])
+    country, = Country.create([{'name': 'Spain', 'code': 'ES'}])
+    carrier_party, customer = Party.create([{
+                'name': 'Seur',
+                }, {
+                'name': 'Customer',
+                'addresses': [('create', [{
+                                'street': 'Street 2',
+                                'zip': '19005',
+                                'city': 'Guadalajara',
+                                'country': country.id,
+                                }])],
+                }])
+    carrier, = Carrier.create([{
+                'party': carrier_party.id,
+                'carrier_product': template.products[0].id,
+                }])
+    CarrierApi.write([api], {
+            'carriers': [('add', [carrier.id])],
+            'services': [('create', [{
+                            'code': '031',
+                            'name': 'Seur 24',
+                            }])],
+            })
+    warehouse, = Location.search([('code', '=', 'WH')])
+    address, = Address.create([{
+                'party': company.party.id,
+                'street': 'Street 1',
+                'zip': '08720',
+                'city': 'Vilafranca del Penedes',
+                'country': country.id,
+                }])
+    Location.write([warehouse], {'address': address.id})
+    shipment_values = {
+        'customer': customer.id,
+        'delivery_address': customer.addresses[0].id,
+        'warehouse': warehouse.id,
+        'carrier': carrier.id,
+        'carrier_service': api.services[0].id,
+        }
+    shipment_values.update(values)
+    return ShipmentOut.create([shipment_values.copy()
+            for _ in range(count)])
+
+
+def create_offline_shipments(company, api, count):
+    '''
+    Create count packed shipments with tracking references pending to send
+    offline by api
+    '''
+    pool = Pool()
+    ShipmentOut = pool.get('stock.shipment.out')
+    SeurOffline = pool.get('carrier.api.seur.offline')
+
+    shipments = create_shipments(company, api, count)
+    to_write = []
+    for i, shipment in enumerate(shipments):
+        to_write.extend(([shipment], {
+                    'state': 'packed',
+                    'carrier_tracking_ref': str(4900000 + i),
+                    }))
+    ShipmentOut.write(*to_write)
+    return SeurOffline.create([{
+                'api': api.id,
+                'shipment': shipment.id,
+                } for shipment in shipments])
+
+
+class QueryCounter(object):
+    'Connection of the transaction that counts the queries of its cursors'
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.count = 0
+
+    def cursor(self, *args, **kwargs):
+        counter = self
+        cursor = self.connection.cursor(*args, **kwargs)
+
+        class Cursor(object):
+            def execute(self, *args, **kwargs):
+                counter.count += 1
+                return cursor.execute(*args, **kwargs)
+
+            def __iter__(self):
+                return iter(cursor)
+
+            def __getattr__(self, name):
+                return getattr(cursor, name)
+        return Cursor()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+@contextmanager
+def count_queries():
+    'Count the queries of the block'
+    transaction = Transaction()
+    connection = transaction.connection
+    transaction.connection = counter = QueryCounter(connection)
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+@contextmanager
+def temporary_labels():
+    'Write the label files of the block to a temporary directory'
+    directory = tempfile.mkdtemp()
+    tempdir = tempfile.tempdir
+    tempfile.tempdir = directory
+    try:
+        yield directory
+    finally:
+        tempfile.tempdir = tempdir
+        shutil.rmtree(directory)
 
 
 class CarrierSendShipmentsSeurTestCase(ModuleTestCase):
@@ -29,6 +218,106 @@ class CarrierSendShipmentsSeurTestCase(ModuleTestCase):
         r = set_seur_reference(min_ref, max_ref, 4920100)
         self.assertEqual(r, 4906100)
 
+    def test_seur_reference_shards(self):
+        'Seur Reference Shards'
+        shards = [(4900000, 4909999), (4910000, 4914999), (4915000, 4920999)]
+        self.assertEqual(seur_reference_overlaps(shards), [])
+        for min_ref, max_ref in shards:
+            for reference in (0, 1, 4999, 5000, 4920100, 10 ** 9):
+                r = set_seur_reference(min_ref, max_ref, reference)
+                self.assertTrue(min_ref <= r <= max_ref)
+
+        self.assertEqual(seur_reference_overlaps(
+                [(4910000, 4920999), (4900000, 4910000)]),
+            [((4900000, 4910000), (4910000, 4920999))])
+
+    @with_transaction()
+    def test_seur_shards(self):
+        'Seur Shards'
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Sequence = pool.get('ir.sequence')
+        CarrierApi = pool.get('carrier.api')
+        Shard = pool.get('carrier.api.seur.shard')
+
+        company = create_company()
+        with set_company(company):
+            api_sequence, sequence, other_sequence = Sequence.create([{
+                        'name': 'Seur %s' % i,
+                        'code': 'carrier.api.seur',
+                        } for i in range(3)])
+            api = create_api(company=company.id,
+                seur_reference=api_sequence.id,
+                seur_minimum_reference=4900000,
+                seur_maximun_reference=4920999)
+            warehouse, = Location.search([('code', '=', 'WH')])
+            input_, output, storage = Location.create([{
+                        'name': name,
+                        'type': 'storage',
+                        } for name in ('Input 2', 'Output 2', 'Storage 2')])
+            other, = Location.create([{
+                        'name': 'Warehouse 2',
+                        'type': 'warehouse',
+                        'input_location': input_.id,
+                        'output_location': output.id,
+                        'storage_location': storage.id,
+                        }])
+
+            # without shards all the warehouses use the api range
+            self.assertEqual(api.get_seur_shard(other),
+                (api_sequence, 4900000, 4920999))
+
+            def check(*shards):
+                'Check the shards of (warehouse, sequence, min, max)'
+                api = CarrierApi(api_id)
+                api.seur_shards = [Shard(api=api, warehouse=w, sequence=s,
+                        minimum_reference=min_ref, maximum_reference=max_ref)
+                    for w, s, min_ref, max_ref in shards]
+                Shard.check_shards(api)
+
+            def assertShardError(message, *shards):
+                with self.assertRaises(UserError) as cm:
+                    check(*shards)
+                self.assertIn(message, cm.exception.message)
+
+            api_id = api.id
+            first = (warehouse, sequence, 4900000, 4909999)
+            check(first, (other, other_sequence, 4910000, 4920999))
+            # overlapping
+            assertShardError('overlap', first,
+                (other, other_sequence, 4909999, 4920999))
+            # out of the api range or reversed
+            assertShardError('must be inside', first,
+                (other, other_sequence, 4910000, 4921000))
+            assertShardError('must be inside',
+                (warehouse, sequence, 4899999, 4909999))
+            assertShardError('must be inside', first,
+                (other, other_sequence, 4920999, 4910000))
+            # duplicate warehouse
+            assertShardError('more than one shard', first,
+                (warehouse, other_sequence, 4910000, 4920999))
+            # shared sequence with another shard or with the api
+            assertShardError('used by another shard', first,
+                (other, sequence, 4910000, 4920999))
+            assertShardError('used by another shard',
+                (warehouse, api_sequence, 4900000, 4909999))
+
+            # the shards are checked when they are saved
+            Shard.create([{
+                        'api': api.id,
+                        'warehouse': warehouse.id,
+                        'sequence': sequence.id,
+                        'minimum_reference': 4900000,
+                        'maximum_reference': 4909999,
+                        }])
+            api = CarrierApi(api.id)
+            self.assertEqual(api.get_seur_shard(warehouse),
+                (sequence, 4900000, 4909999))
+            # a warehouse without shard has no references
+            with self.assertRaises(UserError) as cm:
+                api.get_seur_shard(other)
+            self.assertIn('has not a reference shard', cm.exception.message)
+
     def seur_barcode(self):
         'Seur Barcode'
         from_zip = '19005'
@@ -37,6 +326,771 @@ class CarrierSendShipmentsSeurTestCase(ModuleTestCase):
         barcode = seurbarcode(from_zip, to_zip, reference)
         self.assertEqual(barcode, '19 230 1 8201977 5')
 
+    def test_seur_barcodes(self):
+        'Seur Barcodes'
+        barcodes = seurbarcodes('19005', '23006', ['8201977', 8201978])
+        self.assertEqual(barcodes, [
+                ('19 230 1 8201977 5', '19230182019775'),
+                ('19 230 1 8201978 2', '19230182019782'),
+                ])
+        self.assertEqual([b for b, _ in barcodes],
+            [seurbarcode('19005', '23006', r) for r in ['8201977', '8201978']])
+
+    def test_zpl_template(self):
+        'ZPL Template'
+        tmpl = ZPLTemplate(u'^XA^FN1^FD${bulto}/${total_bultos}^FS'
+            u'^FN2^FD${cliente_telefono}^FS^XZ')
+        zpl = tmpl.render({
+                'bulto': 1,
+                'total_bultos': 2,
+                'cliente_telefono': None,
+                })
+        self.assertEqual(zpl, u'^XA^FN1^FD1/2^FS^FN2^FD^FS^XZ')
+        self.assertRaises(ValueError, ZPLTemplate, u'{% if a %}${a}{% end %}')
+        self.assertEqual(tmpl.stored_format(), None)
+
+        tmpl = ZPLTemplate(u'^XA^DFSEUR.001^FS^FN1^FA9^FS^XZ\n'
+            u'^XA^XFSEUR.001^FS^FN1^FD${bulto}^FS^XZ')
+        format_, recall = tmpl.stored_format()
+        self.assertEqual(format_, u'^XA^DFSEUR.001^FS^FN1^FA9^FS^XZ\n')
+        self.assertEqual(recall.render({'bulto': 1}),
+            u'^XA^XFSEUR.001^FS^FN1^FD1^FS^XZ')
+
+    def test_label_writer(self):
+        'Label Writer'
+        directory = tempfile.mkdtemp()
+        tempdir = tempfile.tempdir
+        tempfile.tempdir = directory
+        try:
+            profile = os.path.join(directory, 'test-seur-send-1-0-1.pstats')
+            old = os.path.join(directory, 'test-seur-label-1-old.zpl')
+            for path in (profile, old):
+                open(path, 'w').close()
+                os.utime(path, (0, 0))
+
+            writer = LabelWriter('test', batch=True, retention=1)
+            self.assertTrue(os.path.exists(profile))
+            self.assertFalse(os.path.exists(old))
+            writer.add('OUT1', '1', b'^XA^XZ')
+            writer.add('OUT2', '2', b'^XA^XZ')
+            labels = writer.close()
+            self.assertEqual(len(labels), 1)
+            self.assertEqual(writer.index_path, labels[0] + '.csv')
+            with open(writer.index_path) as f:
+                self.assertEqual(f.read().splitlines(), [
+                        'shipment,reference,label,count',
+                        'OUT1,1,1,1',
+                        'OUT2,2,2,1',
+                        ])
+        finally:
+            tempfile.tempdir = tempdir
+            shutil.rmtree(directory)
+
+    def test_picking_dispatch(self):
+        'Picking Dispatch'
+        api = FakeApi(seur_workers=3)
+        datas = [picking_data(i) for i in range(20)]
+        with fake_picking(latency=0.001, label_size=100) as picking:
+            results = picking_dispatch(api, 'create', datas)
+            self.assertEqual(len(picking.calls), 20)
+        self.assertEqual(len(set(r for r, _, _ in results)), 20)
+        for data, (reference, label, error) in zip(datas, results):
+            self.assertIn(data['referencia_expedicion'], label)
+            self.assertEqual(len(label), 100)
+            self.assertEqual(error, None)
+
+        with fake_picking(error_rate=1.0):
+            results = picking_dispatch(api, 'create', datas)
+        self.assertEqual(results[0], (None, None, 'Fake Seur error'))
+
+        # a call that raises does not discard the other results
+        with fake_picking(exception_rate=0.5, seed=1) as picking:
+            results = picking_dispatch(api, 'create', datas)
+            failed = len([c for c in picking.calls if c[2]])
+        self.assertTrue(0 < failed < 20)
+        self.assertEqual(len([r for r, _, _ in results if r]), 20 - failed)
+        self.assertTrue(all('Fake connection reset' in e
+                for r, _, e in results if not r))
+
+        # the session of a failed call is not reused
+        api = FakeApi(seur_workers=1)
+        with fake_picking(exception_rate=1.0) as picking:
+            picking_dispatch(api, 'label', datas[:5])
+            self.assertEqual(picking.sessions, 5)
+        with fake_picking() as picking:
+            picking_dispatch(api, 'label', datas[:5])
+            picking_dispatch(api, 'label', datas[:5])
+            self.assertEqual(picking.sessions, 1)
+
+        # an error of the code is raised
+        with fake_picking():
+            self.assertRaises(AttributeError, picking_dispatch, api,
+                'unknown', datas)
+
+        # the worker threads do not read the api
+        main = threading.current_thread()
+
+        class MainThreadApi(FakeApi):
+            def __getattribute__(self, name):
+                assert threading.current_thread() is main, name
+                return super(MainThreadApi, self).__getattribute__(name)
+
+        api = MainThreadApi(seur_workers=3, seur_rate_limit=1000)
+        with fake_picking() as picking:
+            results = picking_dispatch(api, 'label', datas)
+            self.assertEqual(len(picking.calls), 20)
+        self.assertTrue(all(results))
+
+        # the session timeout cancels the call, its outcome is unknown
+        api = FakeApi(seur_workers=3, timeout=0.01)
+        with fake_picking(latency=0.05) as picking:
+            results = picking_dispatch(api, 'create', datas[:3])
+            self.assertTrue(all(d < 0.05 for _, d, _ in picking.calls))
+        self.assertEqual(results, [(None, None, SEUR_TIMEOUT)] * 3)
+
+    def test_circuit_breaker(self):
+        'Circuit Breaker'
+        api = FakeApi(id=-1, seur_workers=1, seur_breaker_errors=2,
+            seur_breaker_latency=0.001, seur_breaker_reset=60)
+        datas = [picking_data(i) for i in range(20)]
+        with fake_picking(latency=0.01) as picking:
+            results = picking_dispatch(api, 'create', datas)
+            self.assertTrue(len(picking.calls) < 20)
+        self.assertEqual(results[-1], (None, None, BREAKER_OPEN))
+        breaker = get_breaker(api)
+        self.assertTrue(breaker.is_open())
+
+        # the connection errors open it in the batch
+        api = FakeApi(id=-2, seur_workers=1, seur_breaker_errors=2)
+        with fake_picking(exception_rate=1.0) as picking:
+            results = picking_dispatch(api, 'create', datas)
+            self.assertEqual(len(picking.calls), 2)
+        self.assertEqual(results[2:], [(None, None, BREAKER_OPEN)] * 18)
+        self.assertTrue(get_breaker(api).is_open())
+
+        # a trial call after the reset closes it again
+        breaker.opened -= 60
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record(True, 0.0001)
+        self.assertFalse(breaker.is_open())
+
+        breaker = CircuitBreaker()
+        breaker.adaptive = True
+        self.assertEqual(breaker.timeout(30), 30)
+        for i in range(100):
+            breaker.record(True, 0.001 * i)
+        self.assertEqual(breaker.percentile(95), 0.094)
+        self.assertEqual(breaker.timeout(30), 5.0)
+        breaker.record(True, 20)
+        self.assertEqual(breaker.timeout(30), 5.0)
+        self.assertEqual(breaker.timeout(2), 2)
+
+    def test_session_pool(self):
+        'Session Pool'
+        class Session(object):
+            closed = 0
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, type, value, traceback):
+                Session.closed += 1
+
+        pool = SessionPool(idle=60, size=1)
+        api = FakeApi(id=1)
+        key = pool.key('picking', api)
+        first = pool.acquire(key, Session)
+        second = pool.acquire(key, Session)
+        self.assertNotEqual(first[0], second[0])
+        pool.release(key, first)
+        pool.release(key, second)
+        # the pool keeps size sessions by key
+        self.assertEqual(Session.closed, 1)
+        self.assertEqual(pool.acquire(key, Session)[0], first[0])
+
+        # a failed session is not reused
+        pool.release(key, first, healthy=False)
+        self.assertEqual(Session.closed, 2)
+
+        # credentials are part of the key
+        api.password = 'new'
+        self.assertNotEqual(pool.key('picking', api), key)
+
+        third = pool.acquire(key, Session)
+        pool.invalidate(1)
+        pool.release(key, third)
+        self.assertEqual(Session.closed, 3)
+        self.assertNotEqual(pool.acquire(key, Session)[0], third[0])
+
+        pool.idle = -1
+        fourth = pool.acquire(key, Session)
+        pool.release(key, fourth)
+        pool.acquire(key, Session)
+        self.assertEqual(Session.closed, 4)
+
+    def test_seur_timer(self):
+        'Seur Timer'
+        timer = SeurTimer('test_disabled')
+        with timer.phase('render'):
+            pass
+        self.assertEqual(timer.close(), None)
+
+        os.environ['SEUR_TIMING'] = '1'
+        try:
+            timer = SeurTimer('test_enabled', shipments=2)
+        finally:
+            del os.environ['SEUR_TIMING']
+        for _ in range(2):
+            with timer.phase('render'):
+                pass
+        with timer.phase('create', 2):
+            pass
+        timing = timer.close()
+        self.assertEqual(timing['shipments'], 2)
+        self.assertEqual(timing['phases']['render'][1], 2)
+        self.assertEqual(timing['phases']['create'][1], 2)
+        self.assertEqual(get_timings('test_enabled')[-1], timing)
+        self.assertEqual(get_timings('test_disabled'), [])
+
+    def test_seur_backoff(self):
+        'Seur Backoff'
+        self.assertEqual(seur_backoff(0), 0)
+        self.assertEqual([seur_backoff(a) for a in range(1, 5)],
+            [60, 120, 240, 480])
+        self.assertEqual(seur_backoff(100), 6 * 3600)
+
+    def test_rate_limiter(self):
+        'Rate Limiter'
+        directory = tempfile.mkdtemp()
+        try:
+            limiter = RateLimiter(os.path.join(directory, 'rate.sqlite'))
+            self.assertEqual([limiter.take('a', 10, 2) for _ in range(2)],
+                [0, 0])
+            self.assertTrue(0 < limiter.take('a', 10, 2) <= 0.1)
+            # buckets are independent
+            self.assertEqual(limiter.take('b', 10, 2), 0)
+            # other processes share the bucket through the file
+            other = RateLimiter(limiter.path)
+            self.assertTrue(other.take('a', 10, 2) > 0)
+            self.assertTrue(limiter.acquire('a', 10, 2) > 0)
+        finally:
+            shutil.rmtree(directory)
+
+    @with_transaction()
+    def test_seur_zip_bulk_load(self):
+        'Seur Zip Bulk Load'
+        SeurZip = Pool().get('carrier.api.seur.zip')
+
+        def table():
+            return sorted((z.codpos_zip, z.codpos_city, z.codpos_country,
+                    z.codpos_code, z.coddest_code, z.coddest_name)
+                for z in SeurZip.search([]))
+
+        rows = [
+            (u'08720', u'VILAFRANCA', u'ES', u'930', u'930', u'BCN-PENEDES'),
+            (u'08720', u'VILAFRANCA', u'ES', u'930', u'930', u'BCN-PENEDES'),
+            (u'08733', u'EL PLA\tDEL\\PENEDES', u'ES', u'930', u'930',
+                u'BCN\nPENEDES'),
+            (u'25001', u'LLEIDA', u'ES', u'250', None, None),
+            ]
+        self.assertEqual(SeurZip.bulk_load(rows, chunk_size=3), (4, 0, 0))
+        self.assertEqual(table(), sorted(rows))
+        self.assertEqual(SeurZip.bulk_load(rows, chunk_size=3), (0, 0, 0))
+        self.assertEqual(table(), sorted(rows))
+
+        rows = [
+            rows[0],
+            (u'08720', u'VILAFRANCA', u'ES', u'930', u'931', u'BCN-OTHER'),
+            rows[3],
+            (u'17001', u'GIRONA', u'ES', u'170', u'170', u'GIRONA'),
+            ]
+        self.assertEqual(SeurZip.bulk_load(rows, chunk_size=3), (1, 1, 1))
+        self.assertEqual(table(), sorted(rows))
+        self.assertEqual(SeurZip.get_index()[(u'17001', u'ES')].coddest_name,
+            u'GIRONA')
+
+    @with_transaction()
+    def test_seur_zip_load(self):
+        'Seur Zip Load'
+        SeurZip = Pool().get('carrier.api.seur.zip')
+
+        directory = tempfile.mkdtemp()
+        try:
+            fcodpos = os.path.join(directory, 'codpos.txt')
+            fcoddest = os.path.join(directory, 'coddest.txt')
+            with open(fcoddest, 'w') as f:
+                f.write('0930002001BCN-PENEDES       1\n')
+            with open(fcodpos, 'w') as f:
+                f.write('0008733EL PLA DEL PENEDES       ES0930\n')
+            self.assertEqual(SeurZip.load(fcodpos, fcoddest), (1, 0, 0))
+            self.assertEqual(SeurZip.load(fcodpos, fcoddest), None)
+            with open(fcodpos, 'a') as f:
+                f.write('0008720VILAFRANCA              ES0930\n')
+            self.assertEqual(SeurZip.load(fcodpos, fcoddest), (1, 0, 0))
+        finally:
+            shutil.rmtree(directory)
+
+    @with_transaction()
+    def test_seur_sequence_numbers(self):
+        'Seur Sequence Numbers'
+        pool = Pool()
+        Sequence = pool.get('ir.sequence')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        values = {
+            'name': 'Seur',
+            'code': 'carrier.api.seur',
+            'prefix': '1',
+            'suffix': '9',
+            'padding': 5,
+            'number_increment': 3,
+            'number_next': 7,
+            }
+        block, single = Sequence.create([values, values.copy()])
+        # the sequence values are cached by a previous get_id
+        self.assertEqual(int(Sequence.get_id(block.id)),
+            int(Sequence.get_id(single.id)))
+        self.assertEqual(ShipmentOut.get_seur_sequence_numbers(block, 4),
+            [int(Sequence.get_id(single.id)) for _ in range(4)])
+        self.assertEqual(ShipmentOut.get_seur_sequence_numbers(block, 2),
+            [1000229, 1000259])
+        # get_id continues after the block
+        self.assertEqual(int(Sequence.get_id(block.id)), 1000289)
+
+    @with_transaction()
+    def test_offline_mail_deliver(self):
+        'Offline Mail Deliver'
+        from trytond.modules.carrier_send_shipments_seur.api import \
+            MAIL_MAX_ATTEMPTS
+        pool = Pool()
+        SMTPServer = pool.get('smtp.server')
+        Mail = pool.get('carrier.api.seur.offline.mail')
+        transaction = Transaction()
+        # deliver commits each mail, the test transaction is rolled back
+        transaction.commit = lambda: None
+
+        api = create_api()
+        server, = SMTPServer.create([{
+                    'name': 'Seur',
+                    'smtp_server': 'localhost',
+                    'smtp_email': 'seur@example.com',
+                    }])
+
+        def create_mail(number):
+            mail, = Mail.create([{
+                        'api': api.id,
+                        'server': server.id,
+                        'filename': 'seur_%s.txt' % number,
+                        'from_': 'seur@example.com',
+                        'recipients': 'seur@example.com,cc@example.com',
+                        'message': 'Message %s' % number,
+                        }])
+            return mail.id
+
+        mail_id = create_mail(1)
+        with fake_smtp(SMTPServer) as smtp:
+            Mail.deliver_pending()
+            # sent mails are not delivered again
+            Mail.deliver([Mail(mail_id)])
+        self.assertEqual(smtp.connections, 1)
+        self.assertEqual(smtp.messages, [('seur@example.com',
+                    ['seur@example.com', 'cc@example.com'], 'Message 1')])
+        self.assertEqual(Mail(mail_id).state, 'sent')
+
+        mail_id = create_mail(2)
+        with fake_smtp(SMTPServer, fail=True) as smtp:
+            Mail.deliver_pending()
+            mail = Mail(mail_id)
+            self.assertEqual(mail.state, 'pending')
+            self.assertEqual(mail.attempts, 1)
+            self.assertTrue(mail.next_attempt > datetime.datetime.now()
+                + datetime.timedelta(seconds=seur_backoff(1) - 10))
+            self.assertIn('Fake SMTP error', mail.error)
+            # the mail is not due before its backoff
+            Mail.deliver_pending()
+            self.assertEqual(Mail(mail_id).attempts, 1)
+
+            for _ in range(MAIL_MAX_ATTEMPTS - 1):
+                Mail.write([Mail(mail_id)], {'next_attempt': None})
+                Mail.deliver_pending()
+        mail = Mail(mail_id)
+        self.assertEqual(mail.attempts, MAIL_MAX_ATTEMPTS)
+        self.assertEqual(mail.state, 'failed')
+
+        Mail.retry([mail])
+        with fake_smtp(SMTPServer) as smtp:
+            Mail.deliver_pending()
+        self.assertEqual(Mail(mail_id).state, 'sent')
+        self.assertEqual(len(smtp.messages), 1)
+
+    @with_transaction()
+    def test_label_store(self):
+        'Label Store'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Label = pool.get('carrier.api.seur.label')
+
+        company = create_company()
+        with set_company(company):
+            api = create_api(seur_label_store=True, seur_label_store_days=1,
+                seur_label_store_size=1)
+            customer, = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }])
+            warehouse, = Location.search([('code', '=', 'WH')])
+            single, double = ShipmentOut.create([{
+                        'customer': customer.id,
+                        'delivery_address': customer.addresses[0].id,
+                        'warehouse': warehouse.id,
+                        'carrier_tracking_ref': reference,
+                        } for reference in ('4900001', '4900002,4900003')])
+
+            Label.store(api, [
+                    (single, '4900001', 1, b'SINGLE', False),
+                    (double, '4900002', 1, b'DOUBLE1', False),
+                    ])
+            labels = Label.get_labels(api, [single, double])
+            # the shipment without a label of each reference is not stored
+            self.assertEqual(list(labels.keys()), [single.id])
+            self.assertEqual(bytes(labels[single.id][0].data), b'SINGLE')
+
+            Label.store(api, [
+                    (double, '4900003', 2, b'DOUBLE2', False),
+                    (single, '4900001', 1, b'REPLACED', False),
+                    ])
+            labels = Label.get_labels(api, [single, double])
+            self.assertEqual([bytes(l.data) for l in labels[double.id]],
+                [b'DOUBLE1', b'DOUBLE2'])
+            self.assertEqual([bytes(l.data) for l in labels[single.id]],
+                [b'REPLACED'])
+            self.assertEqual(Label.search([], count=True), 3)
+
+            # the labels over the size are removed oldest first
+            Label.store(api, [
+                    (single, '4900001', 1, b'x' * 1024 * 1024, False),
+                    ])
+            self.assertEqual(Label.evict_api(api), 2)
+            self.assertEqual([l.reference for l in Label.search([])],
+                ['4900001'])
+
+            # and the labels older than the days
+            table = Label.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*table.update([table.create_date],
+                    [datetime.datetime.now() - datetime.timedelta(days=2)]))
+            self.assertEqual(Label.evict_api(api), 1)
+            self.assertEqual(Label.search([], count=True), 0)
+
+            # the labels of the offline fallback of a PDF api are ZPL
+            api.seur_pdf = True
+            api.save()
+            Label.store(api, [
+                    (single, '4900001', 1, b'^XA^XZ', False),
+                    ], offline=True)
+            self.assertEqual([l.format for l in Label.search([])], ['zpl'])
+            self.assertEqual(Label.get_labels(api, [single]), {})
+            labels = Label.get_labels(api, [single], offline=True)
+            self.assertEqual(bytes(labels[single.id][0].data), b'^XA^XZ')
+
+    @with_transaction()
+    def test_render_seur_files(self):
+        'Render Seur Files'
+        from trytond.modules.carrier_send_shipments_seur.api import \
+            offline_loader
+        pool = Pool()
+        SMTPServer = pool.get('smtp.server')
+        SeurOffline = pool.get('carrier.api.seur.offline')
+        Mail = pool.get('carrier.api.seur.offline.mail')
+
+        company = create_company()
+        with set_company(company):
+            api = create_api(company=company.id, seur_offline=True,
+                seur_filename='seur', seur_email='seur@example.com',
+                seur_max_shipments=2)
+            tmpl = offline_loader.load('offline-send.xml')
+            shipments = []
+            for number in range(5):
+                data = picking_data(number)
+                data['barcodes_compact'] = ['%014d' % number]
+                shipments.append(data)
+
+            def render():
+                'Return the references of the shipments of each file'
+                pages = []
+                for encoded in SeurOffline.render_seur_files(api,
+                        iter(shipments)):
+                    encoded.seek(0)
+                    xml = b64decode(encoded.read())
+                    encoded.close()
+                    # each file is a complete document
+                    root = ElementTree.fromstring(xml)
+                    self.assertEqual(root.tag, 'root')
+                    references = [e.text
+                        for e in root.iter('referencia_expedicion')]
+                    page = [s for s in shipments
+                        if s['referencia_expedicion'] in references]
+                    self.assertEqual(xml, tmpl.generate(ci=api.seur_ci,
+                            vat=api.vat, ccc=api.seur_ccc,
+                            shipments=page).render(encoding='iso-8859-1'))
+                    pages.append(references)
+                self.assertEqual(sum(pages, []),
+                    [s['referencia_expedicion'] for s in shipments])
+                return pages
+
+            self.assertEqual([len(p) for p in render()], [2, 2, 1])
+            api.seur_max_shipments = None
+            api.seur_max_size = 1
+            api.save()
+            self.assertTrue(len(render()) > 1)
+            api.seur_max_size = None
+            api.save()
+            self.assertEqual([len(p) for p in render()], [5])
+
+            # the files of a page are numbered, also when other pages
+            # were sent before
+            api.seur_max_shipments = 2
+            api.save()
+            server, = SMTPServer.create([{
+                        'name': 'Seur',
+                        'smtp_server': 'localhost',
+                        'smtp_email': 'seur@example.com',
+                        }])
+            seur_shipments = create_offline_shipments(company, api, 3)
+            self.assertEqual(SeurOffline.send_seur_page(api, server,
+                    seur_shipments, '010120261200'), 2)
+            self.assertEqual(SeurOffline.send_seur_page(api, server,
+                    seur_shipments[:1], '010120261300', 2, numbered=True), 3)
+            # a single file is not numbered
+            self.assertEqual(SeurOffline.send_seur_page(api, server,
+                    seur_shipments[:1], '010120261400'), 1)
+            self.assertEqual([m.filename
+                    for m in Mail.search([], order=[('id', 'ASC')])], [
+                    'seur_010120261200_1.txt',
+                    'seur_010120261200_2.txt',
+                    'seur_010120261300_3.txt',
+                    'seur_010120261400.txt',
+                    ])
+            self.assertEqual(
+                SeurOffline.search([('state', '=', 'done')], count=True), 3)
+
+    @with_transaction()
+    def test_send_seur_shipments(self):
+        'Send Seur Shipments'
+        pool = Pool()
+        Model = pool.get('ir.model')
+        SMTPServer = pool.get('smtp.server')
+        SeurOffline = pool.get('carrier.api.seur.offline')
+        Mail = pool.get('carrier.api.seur.offline.mail')
+        transaction = Transaction()
+        # each page is committed, the test transaction is rolled back
+        commits = []
+        transaction.commit = lambda: commits.append(True)
+
+        company = create_company()
+        with set_company(company):
+            api = create_api(company=company.id, seur_offline=True,
+                seur_filename='seur', seur_email='seur@example.com')
+            model, = Model.search([
+                    ('model', '=', 'carrier.api.seur.offline'),
+                    ])
+            SMTPServer.create([{
+                        'name': 'Seur',
+                        'smtp_server': 'localhost',
+                        'smtp_email': 'seur@example.com',
+                        'state': 'done',
+                        'models': [('add', [model.id])],
+                        }])
+            create_offline_shipments(company, api, 5)
+
+            if not config.has_section('carrier_send_shipments_seur'):
+                config.add_section('carrier_send_shipments_seur')
+            config.set('carrier_send_shipments_seur', 'offline_page_size',
+                '2')
+            try:
+                SeurOffline.send_seur_offline()
+            finally:
+                config.remove_option('carrier_send_shipments_seur',
+                    'offline_page_size')
+
+            self.assertEqual(len(commits), 3)
+            self.assertEqual(SeurOffline.search([
+                        ('state', '=', 'draft'),
+                        ], count=True), 0)
+            self.assertEqual(SeurOffline.search([
+                        ('state', '=', 'done'),
+                        ], count=True), 5)
+            # one mail of each page, numbered as the first page is full
+            mails = Mail.search([], order=[('id', 'ASC')])
+            self.assertEqual([m.filename[-6:] for m in mails],
+                ['_1.txt', '_2.txt', '_3.txt'])
+            self.assertEqual([m.state for m in mails], ['pending'] * 3)
+
+    @with_transaction()
+    def test_prefetch_seur(self):
+        'Prefetch Seur'
+        ShipmentOut = Pool().get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            api = create_api(company=company.id)
+            shipments = create_shipments(company, api, 12)
+
+            def queries(shipments):
+                with count_queries() as counter:
+                    shipments = ShipmentOut.prefetch_seur(api, shipments)
+                    batch = ShipmentOut.get_seur_batch(api, shipments)
+                    for shipment in shipments:
+                        ShipmentOut.seur_picking_data(api, shipment,
+                            shipment.carrier_service, batch=batch)
+                return counter.count
+
+            # the first batch also reads the api and its relations
+            queries(shipments[:1])
+            # then the queries do not grow with the shipments
+            self.assertEqual(queries(shipments[1:2]), queries(shipments[2:]))
+
+    @with_transaction()
+    def test_seur_picking_data_batch(self):
+        'Seur Picking Data Batch'
+        pool = Pool()
+        Uom = pool.get('product.uom')
+        Country = pool.get('country.country')
+        Address = pool.get('party.address')
+        Location = pool.get('stock.location')
+        CarrierApi = pool.get('carrier.api')
+        SeurZip = pool.get('carrier.api.seur.zip')
+        ShipmentOut = pool.get('stock.shipment.out')
+
+        company = create_company()
+        with set_company(company):
+            kg, = Uom.search([('symbol', '=', 'kg')])
+            g, = Uom.search([('symbol', '=', 'g')])
+            api = create_api(company=company.id, weight=True,
+                weight_unit=kg.id, weight_api_unit=g.id)
+            shipments = create_shipments(company, api, 3,
+                carrier_notes='Fragile', number_packages=2)
+            CarrierApi.write([api], {
+                    'services': [('create', [{
+                                    'code': '77',
+                                    'name': 'Seur International',
+                                    }])],
+                    })
+            portugal, = Country.create([{'name': 'Portugal', 'code': 'PT'}])
+            address, = Address.create([{
+                        'party': shipments[1].customer.id,
+                        'street': 'Rua 1',
+                        'zip': '1000-001',
+                        'city': 'Lisboa',
+                        'country': portugal.id,
+                        }])
+            ShipmentOut.write([shipments[1]], {'delivery_address': address.id})
+            if 'weight_uom' in ShipmentOut._fields:
+                ShipmentOut.write([shipments[2]], {'weight_uom': g.id})
+            SeurZip.bulk_load([
+                    (u'08720', u'VILAFRANCA', u'ES', u'930', u'930',
+                        u'BCN-PENEDES'),
+                    (u'19005', u'GUADALAJARA', u'ES', u'190', u'190',
+                        u'GUADALAJARA'),
+                    (u'1000001', u'LISBOA', u'PT', u'890', u'890', u'LISBOA'),
+                    ])
+
+            def check(offline, weight):
+                records = ShipmentOut.browse(shipments)
+                batch = ShipmentOut.get_seur_batch(api, records, weight,
+                    offline=offline)
+                for shipment in records:
+                    for service in api.services:
+                        self.assertEqual(
+                            ShipmentOut.seur_picking_data(api, shipment,
+                                service, Decimal('10'), weight, batch=batch),
+                            ShipmentOut.seur_picking_data(api, shipment,
+                                service, Decimal('10'), weight,
+                                offline=offline))
+
+            for offline in (False, True):
+                for weight in (False, True):
+                    check(offline, weight)
+
+            # the warehouse without address sends from the company address
+            warehouse, = Location.search([('code', '=', 'WH')])
+            Location.write([warehouse], {'address': None})
+            check(True, True)
+
+    @with_transaction()
+    def test_retry_queue(self):
+        'Retry Queue'
+        pool = Pool()
+        Party = pool.get('party.party')
+        Location = pool.get('stock.location')
+        ShipmentOut = pool.get('stock.shipment.out')
+        Retry = pool.get('carrier.api.seur.retry')
+        transaction = Transaction()
+        # drain commits each batch, the test transaction is rolled back
+        transaction.commit = lambda: None
+
+        company = create_company()
+        with set_company(company):
+            api = create_api(company=company.id)
+            customer, = Party.create([{
+                        'name': 'Customer',
+                        'addresses': [('create', [{}])],
+                        }])
+            warehouse, = Location.search([('code', '=', 'WH')])
+            failed, timeout = ShipmentOut.create([{
+                        'customer': customer.id,
+                        'delivery_address': customer.addresses[0].id,
+                        'warehouse': warehouse.id,
+                        } for _ in range(2)])
+
+            # the call without answer is not queued
+            Retry.enqueue(api, [
+                    (failed, 'Fake Seur error'),
+                    (timeout, SEUR_TIMEOUT),
+                    ])
+            retry, = Retry.search([])
+            self.assertEqual(retry.shipment, failed)
+
+            # the shipment without a carrier of the api is not sent again
+            with fake_picking() as picking:
+                Retry.drain([retry])
+                self.assertEqual(picking.calls, [])
+            self.assertEqual(Retry(retry.id).state, 'done')
+
+            # a failed call is scheduled again, a call without answer fails
+            retry, other = Retry.create([{
+                        'api': api.id,
+                        'shipment': shipment.id,
+                        } for shipment in (failed, timeout)])
+            Retry.failed([retry, other], [
+                    'Not send shipment "%s". Fake Seur error'
+                    % failed.rec_name,
+                    'Not send shipment "%s". %s'
+                    % (timeout.rec_name, SEUR_TIMEOUT),
+                    ])
+            retry, other = Retry(retry.id), Retry(other.id)
+            self.assertEqual((retry.state, retry.attempts), ('pending', 1))
+            self.assertTrue(retry.next_attempt)
+            self.assertEqual((other.state, other.attempts), ('failed', 1))
+
+            # the shipment sent in background is left to print
+            shipment, = create_shipments(company, api, 1)
+            retry, = Retry.create([{
+                        'api': api.id,
+                        'shipment': shipment.id,
+                        }])
+            with temporary_labels(), fake_picking() as picking:
+                Retry.drain([retry])
+                self.assertEqual(len(picking.calls), 1)
+            retry = Retry(retry.id)
+            self.assertEqual(retry.state, 'done')
+            self.assertTrue(retry.shipment.carrier_tracking_ref)
+            self.assertFalse(retry.shipment.carrier_printed)
+
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(
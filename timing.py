@@ -0,0 +1,123 @@
+# This file is part of the carrier_send_shipments_seur module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from trytond.config import config
+
+__all__ = ['SeurTimer', 'get_timings']
+
+logger = logging.getLogger(__name__)
+
+# last batch timings of the process
+_timings = deque(maxlen=config.getint('carrier_send_shipments_seur',
+        'timing_history', default=100))
+_timings_lock = threading.Lock()
+
+
+def timing_enabled():
+    '''
+    Timing is enabled with timing in carrier_send_shipments_seur section of
+    trytond configuration or with SEUR_TIMING environment variable
+    '''
+    return bool(os.environ.get('SEUR_TIMING')
+        or config.getboolean('carrier_send_shipments_seur', 'timing',
+            default=False))
+
+
+def get_timings(name=None):
+    '''
+    Timings of the last batches of the process
+    :param name: str of the batch name to filter
+    Return list of dicts (name, start, total, phases: {phase: (seconds,
+        count)})
+    '''
+    with _timings_lock:
+        timings = list(_timings)
+    if name:
+        timings = [t for t in timings if t['name'] == name]
+    return timings
+
+
+class _NullPhase(object):
+    'Phase of a disabled timer'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+
+    def __init__(self, timer, name, count):
+        self.timer = timer
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.timer.add(self.name, time.time() - self.start, self.count)
+
+
+class SeurTimer(object):
+    '''
+    Durations and counts of the phases of a batch.
+    A disabled timer does nothing, its phases are a shared empty context.
+    '''
+
+    def __init__(self, name, **info):
+        self.enabled = timing_enabled()
+        if not self.enabled:
+            return
+        self.name = name
+        self.info = info
+        self.start = time.time()
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def phase(self, name, count=1):
+        'Context manager that times a phase'
+        if not self.enabled:
+            return _null_phase
+        return _Phase(self, name, count)
+
+    def add(self, name, duration, count=1):
+        'Add duration seconds and count to a phase'
+        if not self.enabled:
+            return
+        with self.lock:
+            seconds, total = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (seconds + duration, total + count)
+
+    def close(self):
+        '''
+        Record the batch timing and log it as a structured record
+        Return dict of the timing or None when disabled
+        '''
+        if not self.enabled:
+            return
+        timing = {
+            'name': self.name,
+            'start': self.start,
+            'total': time.time() - self.start,
+            'phases': dict(self.phases),
+            }
+        timing.update(self.info)
+        with _timings_lock:
+            _timings.append(timing)
+        logger.info('Seur timing %s: %s' % (self.name,
+                json.dumps(timing, sort_keys=True)),
+            extra={'seur_timing': timing})
+        self.enabled = False
+        return timing
@@ -1,36 +1,131 @@
 # This file is part carrier_send_shipments_seur module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import codecs
+import hashlib
 
 def set_seur_reference(min_ref, max_ref, reference):
     modul = max_ref - min_ref + 1
     return (min_ref + (reference % modul))
 
+def seur_reference_overlaps(ranges):
+    '''
+    Overlapping reference ranges
+    :param ranges: list of (min_ref, max_ref)
+    Return list of pairs of overlapping ranges
+    '''
+    overlaps = []
+    ranges = sorted(ranges)
+    for i, (min_ref, max_ref) in enumerate(ranges):
+        for other in ranges[i + 1:]:
+            if other[0] > max_ref:
+                break
+            overlaps.append(((min_ref, max_ref), other))
+    return overlaps
+
+def seurbarcodes(from_zip, to_zip, references, transport=1):
+    '''
+    Seur barcodes of references from one origin to one destination
+    :param from_zip: str
+    :param to_zip: str
+    :param references: list of references
+    :param transport: int
+    Return list of (barcode, compact barcode)
+    '''
+    origin = from_zip[:2]
+    destination = to_zip[:3]
+
+    # the checksum is the sum of the digits of origin and reference, odd
+    # positions weight 3. The origin sum is the same for all references.
+    origin_total = 0
+    for i, c in enumerate(origin):
+        digit = ord(c) - 48
+        if not 0 <= digit <= 9:
+            raise ValueError('Invalid Seur barcode origin %s' % from_zip)
+        origin_total += digit * 3 if i % 2 == 0 else digit
+    odd = len(origin) % 2 == 0
+
+    prefix = '%s %s %s ' % (origin, destination, transport)
+    compact_prefix = '%s%s%s' % (origin, destination, transport)
+    barcodes = []
+    for reference in references:
+        reference = '%s' % reference
+        total = origin_total
+        weight_odd = odd
+        for c in reference:
+            digit = ord(c) - 48
+            if not 0 <= digit <= 9:
+                raise ValueError('Invalid Seur reference %s' % reference)
+            total += digit * 3 if weight_odd else digit
+            weight_odd = not weight_odd
+        control = 9 - total % 10
+        barcodes.append(('%s%s %s' % (prefix, reference, control),
+                '%s%s%s' % (compact_prefix, reference, control)))
+    return barcodes
+
 def seurbarcode(from_zip, to_zip, reference, transport=1):
-    base = '%s%s' % (from_zip[:2], reference)
-
-    even = 0
-    odd = 0
-    for i in range(0, len(base)):
-        digit = int(base[i])
-        if (i +1 ) % 2 == 0:
-            even += digit
-        else:
-            odd += digit
-
-    odd = odd * 3
-    total = even + odd
-
-    last = int(str(total)[-1:])
-    if last == 0:
-        control = 9
-    else:
-        control = (10 - last) - 1
-
-    return '%(from_zip)s %(to_zip)s %(transport)s %(reference)s %(control)s' % {
-        'from_zip': from_zip[:2],
-        'to_zip': to_zip[:3],
-        'transport': transport,
-        'reference': reference,
-        'control': control,
-        }
+    return seurbarcodes(from_zip, to_zip, [reference], transport)[0][0]
+
+def seur_backoff(attempts, base=60, maximum=6 * 3600):
+    '''
+    Seconds to wait before a new attempt, doubled on each attempt
+    :param attempts: int of failed attempts
+    :param base: int seconds of the first wait
+    :param maximum: int seconds of the longest wait
+    '''
+    if attempts < 1:
+        return 0
+    return min(base * 2 ** min(attempts - 1, 32), maximum)
+
+def seur_zip_rows(fcodpos, fcoddest):
+    '''
+    Parse the Seur codpos and coddest files in a single pass
+    :param fcodpos: path of codpos file
+    :param fcoddest: path of coddest file
+    Yield (codpos_zip, codpos_city, codpos_country, codpos_code,
+        coddest_code, coddest_name) for each codpos line
+    '''
+    # coddest:
+    # 0930002001BCN-PENEDES       1
+    # coddest_code: 930
+    # coddest_name: BCN-PENEDES
+    coddest = {}
+    with codecs.open(fcoddest, 'r', 'UTF-8') as f:
+        for line in f:
+            coddest[line[1:4]] = line[10:28].rstrip()
+
+    # codpos:
+    # 0008733EL PLA DEL PENEDES       ES0930
+    # codpos_zip:08733
+    # codpos_city: EL PLA DEL PENEDES
+    # codpos_country: ES
+    # codpos_code: 930
+    with codecs.open(fcodpos, 'r', 'UTF-8') as f:
+        for line in f:
+            codpos_code = line[35:38]
+            codpos_country = line[32:34]
+            codpos_zip = None
+            if codpos_country in ['ES']:
+                codpos_zip = line[2:7]
+            if codpos_country in ['PT']:
+                codpos_zip = line[0:7]
+            coddest_code = None
+            coddest_name = coddest.get(codpos_code)
+            if coddest_name is not None:
+                coddest_code = codpos_code
+            yield (codpos_zip, line[7:32].rstrip(), codpos_country,
+                codpos_code, coddest_code, coddest_name)
+
+
+def seur_zip_fingerprint(*paths):
+    '''
+    Fingerprint of the Seur codpos and coddest files
+    :param paths: file paths
+    Return hexadecimal sha1 digest
+    '''
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+    return digest.hexdigest()